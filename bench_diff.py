@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks diff_service on large pairs of fixlet revisions, comparing the
+character-level diff against the hierarchical (line-level first) diff.
+
+Pairs are the largest revisions in the database together with the previous
+revision of the same fixlet. Without a database, pairs are generated from the
+synthetic corpus (see synthetic_corpus.py) by editing a few lines of each
+fixlet.
+
+e.g.
+python bench_diff.py --pairs 20
+'''
+
+import argparse
+import json
+import os.path
+import random
+import sys
+import timeit
+
+import database
+import diff_service
+import fixlet_parser
+import synthetic_corpus
+
+def database_pairs(dbname, count):
+    '''
+    Returns up to 'count' pairs (old contents, new contents) of adjacent
+    revisions, largest first.
+    '''
+    pairs = [] # (size, old contents, new contents)
+    # the largest of each batch of sites (see database.connect_across)
+    for connection in database.connect_across(dbname):
+        rows = connection.execute('''
+Select (Select P.rowid From Revisions P
+        Where P.site=N.site And P.fixlet_id=N.fixlet_id And P.version<N.version
+        Order By P.version Desc Limit 1) As old, C.id, length(C.contents)
+From RevisionContents C, Revisions N
+Where N.rowid=C.id And old Is Not Null
+Order By length(C.contents) Desc Limit ?''', (count,)).fetchall()
+        pairs += [(size, diff_service.load_contents(connection, old_id),
+                   diff_service.load_contents(connection, new_id))
+                  for old_id, new_id, size in rows]
+    pairs.sort(key=lambda pair: pair[0], reverse=True)
+    return [(old, new) for size, old, new in pairs[:count]]
+
+def edit(rng, string, edits):
+    '''
+    Returns the string with a few of its lines replaced, removed or duplicated.
+    '''
+    lines = string.split('\n')
+    for i in range(edits):
+        at = rng.randrange(len(lines))
+        choice = rng.random()
+        if choice < 0.4:
+            lines[at] = lines[at].replace('e', 'E', 1) + ' modified'
+        elif choice < 0.7 and len(lines) > 1:
+            del lines[at]
+        else:
+            lines.insert(at, lines[at] + ' inserted')
+    return '\n'.join(lines)
+
+def synthetic_pairs(count, action_size, edits):
+    '''
+    Returns 'count' pairs (old contents, new contents) of synthetic fixlet
+    revisions with large action scripts and descriptions.
+    '''
+    rng = random.Random(0)
+    text = synthetic_corpus.fxffile(count, 1, action_size)
+    pairs = []
+    for row in fixlet_parser.parse_fxffile_rows(text):
+        old = json.loads(row.contents)
+        old['text'] = [old['text'][0] * (action_size // 1000 + 1)]
+        new = dict((key, [edit(rng, value, edits) for value in old[key]]) for key in old)
+        pairs.append((old, new))
+    return pairs
+
+def hierarchical_diff(old_string, new_string):
+    '''
+    Diff two strings the way the server does (see diff_service.diff).
+    '''
+    diff_service.HIERARCHICAL_DIFF = True
+    return diff_service.diff(old_string, new_string)
+
+def measure(pairs, diff, repeat):
+    '''
+    Diff every pair with the given function and return the best elapsed time
+    and the total number of opcodes produced.
+    '''
+    best = None
+    for i in range(repeat):
+        opcodes = 0
+        start = timeit.default_timer()
+        for old, new in pairs:
+            for key in diff_service.ALL_KEYS:
+                for before, after in zip(old[key], new[key]):
+                    before, after = map(diff_service.preprocess_input, (before, after))
+                    codes = diff(before, after)
+                    diff_service.transform_output(before, after, codes)
+                    opcodes += len(codes)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, opcodes
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark diff_service on large revision pairs.')
+    parser.add_argument('--database', default=diff_service.DBNAME,
+                        help='database to take revision pairs from, if it exists')
+    parser.add_argument('--pairs', type=int, default=10, help='number of revision pairs')
+    parser.add_argument('--action-size', type=int, default=20000,
+                        help='approximate characters per synthetic action script')
+    parser.add_argument('--edits', type=int, default=5, help='line edits per synthetic string')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per mode (best is kept)')
+    options = parser.parse_args(argv)
+
+    if os.path.exists(options.database):
+        print 'using the largest revisions in ' + options.database
+        pairs = database_pairs(options.database, options.pairs)
+    else:
+        print 'using synthetic revisions'
+        pairs = synthetic_pairs(options.pairs, options.action_size, options.edits)
+
+    for old, new in pairs:
+        for key in diff_service.ALL_KEYS:
+            m = max(len(old[key]), len(new[key]))
+            old[key] += [u''] * (m-len(old[key]))
+            new[key] += [u''] * (m-len(new[key]))
+    size = sum(len(string) for pair in pairs for contents in pair
+               for key in diff_service.ALL_KEYS for string in contents[key])
+    print '{} pairs, {:.2f} MB'.format(len(pairs), size / 2.0**20)
+
+    # character_diff is called directly: diff_service.diff would hand strings
+    # over MAX_CHARACTER_DIFF_SIZE to the hierarchical diff
+    for name, diff in (('character', diff_service.character_diff),
+                       ('hierarchical', hierarchical_diff)):
+        elapsed, opcodes = measure(pairs, diff, options.repeat)
+        print '{:<14} {:>10.3f} s {:>10.2f} MB/s {:>10} opcodes'.format(
+            name, elapsed, size / 2.0**20 / max(elapsed, 1e-9), opcodes)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
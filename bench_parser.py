@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+'''
+Offline throughput benchmarks for fixlet_parser, run against a synthetic
+corpus (see synthetic_corpus.py).
+
+Reports MB/s and items/s (directory entries or fixlets) for
+parse_directory, parse_directory_metadata and parse_fxffile. When given a
+baseline file, exits with a non-zero status if any throughput fell below the
+baseline by more than the tolerance.
+
+e.g.
+python bench_parser.py --save bench_baseline.json
+python bench_parser.py --baseline bench_baseline.json
+'''
+
+import argparse
+import json
+import sys
+import timeit
+
+import fixlet_parser
+import synthetic_corpus
+
+def measure(func, texts, items, repeat):
+    '''
+    Run func over each of the texts 'repeat' times and return the best
+    throughput as a tuple (MB/s, items/s), where 'items' is the number of
+    items contained in all of the texts.
+    '''
+    size = sum(map(len, texts))
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        for text in texts:
+            func(text)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    best = max(best, 1e-9)
+    return (size / best / 2**20, items / best)
+
+def run(options):
+    '''
+    Generate the corpus and run every benchmark. Returns a dictionary from
+    benchmark name to a dictionary of its throughputs.
+    '''
+    files = synthetic_corpus.site_files(options.files, options.fixlets,
+                                        options.relevance_depth, options.action_size)
+    listings = [synthetic_corpus.gather_listing('synthetic', 1, files, hashinfo=True),
+                synthetic_corpus.gather_listing('synthetic', 1, files, hashinfo=False)]
+    texts = [text for name, text in files]
+
+    benchmarks = [
+        ('parse_directory', fixlet_parser.parse_directory,
+         listings, len(files) * len(listings)),
+        ('parse_directory_metadata', fixlet_parser.parse_directory_metadata,
+         listings, len(listings)),
+        ('parse_fxffile', fixlet_parser.parse_fxffile,
+         texts, options.files * options.fixlets),
+    ]
+
+    results = {}
+    for name, func, inputs, items in benchmarks:
+        mb_per_s, items_per_s = measure(func, inputs, items, options.repeat)
+        results[name] = {'mb_per_s': mb_per_s, 'items_per_s': items_per_s}
+        print '{:<26} {:>10.2f} MB/s {:>12.1f} items/s'.format(name, mb_per_s, items_per_s)
+    return results
+
+def regressions(results, baseline, tolerance):
+    '''
+    Returns a list of messages describing each throughput in the results
+    which fell below (1 - tolerance) times its baseline.
+    '''
+    failures = []
+    for name in sorted(baseline):
+        if not name in results:
+            continue
+        for metric in baseline[name]:
+            floor = baseline[name][metric] * (1 - tolerance)
+            if results[name][metric] < floor:
+                failures.append('{} {}: {:.2f} < {:.2f}'.format(
+                    name, metric, results[name][metric], floor))
+    return failures
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark fixlet_parser on a synthetic corpus.')
+    parser.add_argument('--files', type=int, default=20, help='number of fxf files')
+    parser.add_argument('--fixlets', type=int, default=50, help='fixlets per fxf file')
+    parser.add_argument('--relevance-depth', type=int, default=2,
+                        help='nesting depth of multipart/digest sections')
+    parser.add_argument('--action-size', type=int, default=2000,
+                        help='approximate characters of action script per fixlet')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark (best is kept)')
+    parser.add_argument('--baseline', help='JSON file of throughputs to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional drop below the baseline')
+    parser.add_argument('--save', help='write the measured throughputs to this JSON file')
+    options = parser.parse_args(argv)
+
+    results = run(options)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            failures = regressions(results, json.load(f), options.tolerance)
+        for failure in failures:
+            print 'regression: ' + failure
+        if failures:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
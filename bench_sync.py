@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+'''
+End-to-end benchmark of dataminer.seed() and dataminer.update() against a
+local stand-in for sync.bigfix.com (see fake_sync.py).
+
+Runs a seed with every site published up to --seed-version, then one update
+per --update-step until every site is at --versions, in a fresh working
+directory. For each run, reports the wall time, the requests served by kind
+and status, the bytes served and the size of the database.
+
+e.g.
+python bench_sync.py --versions 30 --seed-version 10 --update-step 5 --latency 0.01
+'''
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import dataminer
+import database
+import fake_sync
+
+def database_size():
+    '''
+    Returns the size in bytes of the database, including every shard of a
+    sharded database.
+    '''
+    return sum(os.path.getsize(name) for name in
+               [database.DBNAME] + glob.glob(database.shard_name(database.DBNAME, '*')))
+
+def run(server, name, func):
+    '''
+    Run func (dataminer.seed or dataminer.update) and return a dictionary of
+    its measurements.
+    '''
+    requests_before = server.requests.copy()
+    bytes_before = server.bytes
+    start = timeit.default_timer()
+    func()
+    elapsed = timeit.default_timer() - start
+
+    requests = server.requests - requests_before
+    result = {'run': name,
+              'seconds': elapsed,
+              'requests': sum(requests.values()),
+              'requests_by_kind': dict(('{} {}'.format(kind, status), count)
+                                       for (kind, status), count in requests.iteritems()),
+              'bytes': server.bytes - bytes_before,
+              'database_bytes': database_size()}
+    print '{:<12} {:>9.2f} s {:>7} requests {:>9.2f} MB served {:>9.2f} MB database'.format(
+        name, elapsed, result['requests'], result['bytes'] / 2.0**20,
+        result['database_bytes'] / 2.0**20)
+    for kind in sorted(result['requests_by_kind']):
+        print '    {:<20} {:>7}'.format(kind, result['requests_by_kind'][kind])
+    return result
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark seed and update against a local fake sync server.')
+    fake_sync.add_arguments(parser)
+    parser.add_argument('--seed-version', type=int, default=10,
+                        help='version every site is published at when seeding')
+    parser.add_argument('--update-step', type=int, default=5,
+                        help='versions published between updates')
+    parser.add_argument('--sharded', action='store_true',
+                        help='create a sharded database (see database.SHARDED)')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the working directory (database, caches, metrics)')
+    parser.add_argument('--save', help='write the measurements to this JSON file')
+    options = parser.parse_args(argv)
+
+    database.SHARDED = options.sharded
+    server = fake_sync.create_server(options)
+    server.start()
+
+    save = os.path.abspath(options.save) if options.save else None
+    workdir = tempfile.mkdtemp(prefix='bench_sync_')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results = []
+    try:
+        with open(dataminer.GATHER_SITES, 'w') as f:
+            f.write('\n'.join(server.gather_urls()) + '\n')
+
+        def publish(version):
+            for site in server.sites.values():
+                site.publish(version)
+
+        version = min(options.seed_version, options.versions)
+        publish(version)
+        results.append(run(server, 'seed {}'.format(version), dataminer.seed))
+        while version < options.versions:
+            version = min(version + max(options.update_step, 1), options.versions)
+            publish(version)
+            results.append(run(server, 'update {}'.format(version), dataminer.update))
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        if options.keep:
+            print 'working directory: ' + workdir
+        else:
+            shutil.rmtree(workdir)
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
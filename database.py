@@ -1,12 +1,38 @@
 
+import os.path
 import sqlite3
 import traceback
 
+import metrics
+
 '''
 Name of the database to read site data from and to dump fixlet file data to.
 '''
 DBNAME = 'fxfdata.db'
 
+'''
+Whether a new database is sharded: split into a small catalog (DBNAME, with
+the tables in CATALOG_TABLE_SQL) and one file per site next to it (with the
+tables in SITE_TABLE_SQL), so that sites are written to without waiting on
+each other's write lock, e.g. while seed.py seeds several sites at the same
+time (update.py still updates one site at a time). An existing database keeps
+the layout it was created with.
+'''
+SHARDED = False
+
+'''
+The rowids of a shard's FxfFiles, FxfRevisions and Revisions start at its
+site id shifted left by this many bits, so that they are unique across
+shards.
+'''
+SHARD_ID_BITS = 32
+
+'''
+Most shards attached to one connection (SQLite's default SQLITE_MAX_ATTACHED).
+Reads across more sites take several connections, see connect_across.
+'''
+MAX_ATTACHED_SHARDS = 10
+
 '''
 Default enumeration of revision types.
 '''
@@ -18,36 +44,75 @@ REVISION_TYPES = {
     'missing': 4,
 }
 
+'''
+Names of revision types, indexed by their value in REVISION_TYPES.
+'''
+REVISION_TYPE_NAMES = dict((value, key) for key, value in REVISION_TYPES.iteritems())
+
+'''
+valid_to of a fixlet revision which is still the latest of its fixlet: larger
+than any site version, so that the revisions valid at some version are one
+range scan of the RevisionsValid index (valid_to > version).
+'''
+VALID_FOREVER = 2**31 - 1
+
 # TODO add non-NULL column constraints everywhere?
-TABLE_SQL = [
-'''CREATE TABLE RevisionTypes (
+
+# tables of the whole application, which hold little data
+CATALOG_TABLE_SQL = [
+'''CREATE TABLE IF NOT EXISTS RevisionTypes (
   id integer primary key,
   name text)''',
 
-'''CREATE TABLE Sites (
+'''CREATE TABLE IF NOT EXISTS Sites (
   name text,
   url text)''',
 
+'''CREATE TABLE IF NOT EXISTS SiteVersions (
+  site integer references Sites(rowid),
+  version integer,
+  primary key (site))''',
+
+'''CREATE TABLE IF NOT EXISTS DiffCache (
+  old integer references RevisionContents(id),
+  new integer references RevisionContents(id),
+  algorithm integer,
+  contents text,
+  size integer,
+  last_used real,
+  primary key (old, new, algorithm))''',
+
+# size comes after the contents in each row, so this covers the scans which
+# only need sizes (the total size and eviction) to keep them off the contents
+'''CREATE INDEX IF NOT EXISTS DiffCacheUse ON DiffCache (last_used, size)''',
+
+# replaced by DiffCacheUse
+'''DROP INDEX IF EXISTS DiffCacheLastUsed''',
+]
+
+# tables of fixlet files and fixlets, which hold the data of each site and are
+# split into one file per site in a sharded database (see SHARDED)
+SITE_TABLE_SQL = [
 # TODO add primary key(site, name) constraint?
-'''CREATE TABLE FxfFiles (
+'''CREATE TABLE IF NOT EXISTS FxfFiles (
   site integer references Sites(rowid),
   latest integer,
   disk_latest integer,
   name text)''',
-  
-'''CREATE TABLE FxfRevisions (
+
+'''CREATE TABLE IF NOT EXISTS FxfRevisions (
   fxf integer references FxfFiles(rowid),
   version integer,
   type integer references RevisionType(id),
   source_url text,
   primary key (fxf, version))''',
 
-'''CREATE TABLE FxfContents (
+'''CREATE TABLE IF NOT EXISTS FxfContents (
   revision integer references FxfRevisions(rowid),
   text contents,
   primary key (revision))''',
 
-'''CREATE TABLE Revisions (
+'''CREATE TABLE IF NOT EXISTS Revisions (
   site integer references Sites(rowid),
   fixlet_id integer,
   version integer,
@@ -55,20 +120,66 @@ TABLE_SQL = [
   published date,
   title text,
   source_file integer references FxfRevisions(rowid),
+  valid_from integer,
+  valid_to integer,
   primary key (site, fixlet_id, version))''',
 
-'''CREATE TABLE RevisionContents (
+# a revision is valid from its version until the version of the next revision
+# of its fixlet (VALID_FOREVER for the latest), so a snapshot of a site at
+# some version is every revision with valid_from <= version < valid_to
+'''CREATE INDEX IF NOT EXISTS RevisionsValid ON Revisions (site, valid_to, valid_from)''',
+
+# the site history pages list revisions in pages ordered by this index (see
+# main.js), published is included so that no row has to be read
+'''CREATE INDEX IF NOT EXISTS RevisionsHistory ON Revisions (site, version, type, fixlet_id, published)''',
+
+'''CREATE TABLE IF NOT EXISTS RevisionContents (
   id integer references Revisions(rowid),
   contents text,
   primary key (id))''',
+
+'''CREATE TABLE IF NOT EXISTS GatherEntries (
+  site integer references Sites(rowid),
+  version integer,
+  name text,
+  size integer,
+  hash text,
+  primary key (site, version, name))''',
+]
+
+TABLE_SQL = CATALOG_TABLE_SQL + SITE_TABLE_SQL
+
+# columns added to tables after they were first created, as (table, column,
+# statement filling in the column for existing rows)
+COLUMN_SQL = [
+('Revisions', 'valid_from integer',
+'''UPDATE Revisions SET valid_from=version'''),
+
+('Revisions', 'valid_to integer',
+'''UPDATE Revisions SET valid_to=coalesce(
+  (SELECT min(N.version) FROM Revisions N
+   WHERE N.site=Revisions.site AND N.fixlet_id=Revisions.fixlet_id AND N.version>Revisions.version),
+  {}) WHERE version IS NOT NULL'''.format(VALID_FOREVER)),
 ]
 
+SITE_TABLES = ('FxfFiles', 'FxfRevisions', 'FxfContents', 'Revisions', 'RevisionContents',
+               'GatherEntries')
+
+# site tables whose implicit rowids are referenced by other tables
+ID_TABLES = ('FxfFiles', 'FxfRevisions', 'Revisions')
+
+# only in the catalog of a sharded database
+SHARDS_SQL = '''CREATE TABLE IF NOT EXISTS Shards (
+  site integer references Sites(rowid),
+  filename text,
+  primary key (site))'''
+
 class CursorGenerator:
     '''
     Wraps a sqlite3 cursor generator into a kind of "stream".
     '''
-    def __init__(self, cursor, sql):
-        cursor.execute(sql)
+    def __init__(self, cursor, sql, args=()):
+        cursor.execute(sql, args)
         self.cursor = cursor
         self.next_row = None
     def _refresh(self):
@@ -84,6 +195,27 @@ class CursorGenerator:
         self.next_row = None
         return ret
 
+ROWS_INSERTED = metrics.counter('db_rows_inserted_total', 'Rows inserted or replaced, per table',
+                                ('table',))
+TRANSACTION_SECONDS = metrics.histogram('db_transaction_seconds',
+                                        'Duration of atomic() transactions, including the commit')
+
+# statement -> table it inserts into (None for other statements)
+_insert_tables = {}
+
+def _insert_table(sql):
+    '''
+    Returns the table which an INSERT statement inserts into, or None if the
+    statement is not an INSERT.
+    '''
+    if not sql in _insert_tables:
+        words = sql.replace('(', ' ').upper().split()
+        table = None
+        if len(words) > 0 and words[0] == 'INSERT' and 'INTO' in words:
+            table = sql.replace('(', ' ').split()[words.index('INTO') + 1]
+        _insert_tables[sql] = table
+    return _insert_tables[sql]
+
 class ConnectionWrapper:
     '''
     Wraps a sqlite3 connection so as to reduce syntax for
@@ -95,13 +227,22 @@ class ConnectionWrapper:
         self.cursor = None
     def query(self, sql, *args):
         self.cursor = self.connection.execute(sql, args)
+        table = _insert_table(sql)
+        if table is not None:
+            ROWS_INSERTED.inc(self.cursor.rowcount, table=table)
         return self.cursor.fetchone()
     def _query_debug(self, sql, *args):
         print sql, args
         self.query(sql, *args)
-    def query_generator(self, sql):
+    def query_many(self, sql, rows):
+        self.cursor = self.connection.executemany(sql, rows)
+        table = _insert_table(sql)
+        if table is not None:
+            ROWS_INSERTED.inc(self.cursor.rowcount, table=table)
+        return self.cursor.rowcount
+    def query_generator(self, sql, *args):
         self.cursor = self.connection.cursor()
-        return CursorGenerator(self.cursor, sql)
+        return CursorGenerator(self.cursor, sql, args)
 
 def revtype(type_str):
     '''
@@ -110,36 +251,260 @@ def revtype(type_str):
     '''
     return REVISION_TYPES[type_str]
 
-def atomic(func, dbname=DBNAME):
+def revtype_name(revision_type):
     '''
-    Run the given function in a single database transaction.
+    Given the constant of a revision type in the db, this returns its name
+    (or the constant as a string if it is unknown)
+    '''
+    return REVISION_TYPE_NAMES.get(revision_type, str(revision_type))
+
+def find_site(dbname, site):
+    '''
+    Returns the id and name of a site, given either its name or its id.
+    Raises KeyError if there is no such site.
+    '''
+    connection = connect(dbname, create=False)
+    try:
+        row = connection.execute('SELECT rowid, name FROM Sites WHERE name=? OR rowid=?',
+                                 (site, site)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        raise KeyError('no site ' + str(site))
+    return row
+
+def _add_columns(db):
+    '''
+    Add the columns of COLUMN_SQL which existing tables are missing.
+    '''
+    for table, column, fill in COLUMN_SQL:
+        columns = [row[1] for row in db.connection.execute('PRAGMA table_info({})'.format(table))]
+        if len(columns) > 0 and not column.split()[0] in columns:
+            db.query('ALTER TABLE {} ADD COLUMN {}'.format(table, column))
+            db.query(fill)
+
+def _has_shards(connection):
+    return connection.execute("""SELECT count(*) FROM sqlite_master WHERE type='table' AND name='Shards'""").fetchone()[0] == 1
+
+_sharded = {} # database name -> whether it is sharded
+
+def sharded(dbname=DBNAME):
     '''
+    Returns whether a database is sharded (see SHARDED).
+    '''
+    if not dbname in _sharded:
+        connection = sqlite3.connect(dbname)
+        try:
+            _sharded[dbname] = _has_shards(connection)
+        finally:
+            connection.close()
+    return _sharded[dbname]
+
+def shard_name(dbname, site):
+    '''
+    Returns the path of the shard of a site, e.g. fxfdata.site3.db.
+    '''
+    return '{}.site{}.db'.format(os.path.splitext(dbname)[0], site)
+
+def shards(dbname=DBNAME):
+    '''
+    Returns the ids of the sites which have a shard in a sharded database, or
+    [None] if the database is not sharded, so that a connection for each (see
+    connect) covers every site one file at a time.
+    '''
+    connection = sqlite3.connect(dbname)
+    try:
+        if not _has_shards(connection):
+            return [None]
+        return [site for (site,) in connection.execute('SELECT site FROM Shards ORDER BY site')]
+    finally:
+        connection.close()
+
+def rowid_site(rowid):
+    '''
+    Returns the id of the site whose shard holds the row of FxfFiles,
+    FxfRevisions or Revisions (or RevisionContents) with some rowid, in a
+    sharded database.
+    '''
+    return rowid >> SHARD_ID_BITS
+
+def id_range(site):
+    '''
+    Returns the range (first, last + 1) of the rowids of FxfFiles, FxfRevisions
+    and Revisions in the shard of a site, or one covering every rowid if
+    'site' is None (see shards).
+    '''
+    if site is None:
+        return (0, 2**63 - 1)
+    return (site << SHARD_ID_BITS, (site + 1) << SHARD_ID_BITS)
+
+def connect(dbname=DBNAME, site=None, create=True):
+    '''
+    Returns a sqlite3 connection to the database.
+
+    In a sharded database, a connection for some site is to the site's shard
+    (which is created if it is missing), with the catalog attached as
+    'catalog' so that its tables can be read and written too. Any other
+    connection is to the catalog on its own; see connect_across to read the
+    tables of SITE_TABLE_SQL across sites.
+
+    Tools which only read pass 'create' as False: a missing database or shard
+    then raises IOError instead of being created empty.
+    '''
+    if not create and not os.path.exists(dbname):
+        raise IOError('no database ' + dbname)
     connection = sqlite3.connect(dbname)
+    if site is None or not _has_shards(connection):
+        return connection
+
+    connection.close()
+    filename = shard_name(dbname, site)
+    exists = os.path.exists(filename)
+    if not create and not exists:
+        raise IOError('no shard of site {} ({})'.format(site, filename))
+    connection = sqlite3.connect(filename)
+    connection.execute('ATTACH DATABASE ? AS catalog', (dbname,))
+    if not exists:
+        with connection:
+            for statement in SITE_TABLE_SQL:
+                connection.execute(statement)
+            # SQLite gives each new row a rowid one more than the largest
+            # rowid of its table, so a placeholder row (with no site) at the
+            # start of the shard's range keeps every rowid of the shard in it
+            for table in ID_TABLES:
+                connection.execute('INSERT INTO {} (rowid) VALUES (?)'.format(table),
+                                   (site << SHARD_ID_BITS,))
+            connection.execute('INSERT OR REPLACE INTO catalog.Shards VALUES (?,?)',
+                               (site, os.path.basename(filename)))
+    return connection
+
+def connect_across(dbname=DBNAME):
+    '''
+    Generates connections which together read the tables of SITE_TABLE_SQL
+    across every site, each one closed once the next is asked for: a query
+    across sites is run on each connection and the results are combined.
+
+    A database which is not sharded takes one connection. In a sharded
+    database, each connection is to the catalog with up to
+    MAX_ATTACHED_SHARDS shards attached, and temporary views named after each
+    table of SITE_TABLE_SQL reading across those shards, so that queries are
+    unchanged.
+    '''
+    connection = sqlite3.connect(dbname)
+    try:
+        if not _has_shards(connection):
+            yield connection
+            return
+        shards = connection.execute('SELECT site, filename FROM Shards ORDER BY site').fetchall()
+    finally:
+        connection.close()
+
+    for i in range(0, max(len(shards), 1), MAX_ATTACHED_SHARDS):
+        connection = sqlite3.connect(dbname)
+        try:
+            _attach_shards(connection, dbname, shards[i:i+MAX_ATTACHED_SHARDS])
+            yield connection
+        finally:
+            connection.close()
+
+def _attach_shards(connection, dbname, shards):
+    if len(shards) == 0:
+        for statement in SITE_TABLE_SQL:
+            connection.execute(statement.replace('CREATE TABLE', 'CREATE TEMP TABLE'))
+        return
+
+    directory = os.path.dirname(dbname)
+    for site, filename in shards:
+        connection.execute('ATTACH DATABASE ? AS site{}'.format(site),
+                           (os.path.join(directory, filename),))
+    for table in SITE_TABLES:
+        columns = 'rowid AS rowid, *' if table in ID_TABLES else '*'
+        connection.execute('CREATE TEMP VIEW {} AS '.format(table) + ' UNION ALL '.join(
+            'SELECT {} FROM site{}.{}'.format(columns, site, table) for site, filename in shards))
+
+def next_rowids(dbname=DBNAME, table='Revisions'):
+    '''
+    Returns a dictionary from the first rowid of the range of each shard (see
+    id_range) to the rowid which the next row of 'table' in that shard will
+    get, reading one shard at a time.
+    '''
+    rowids = {}
+    for site in shards(dbname):
+        connection = connect(dbname, site)
+        try:
+            rowids[id_range(site)[0]] = connection.execute(
+                'SELECT coalesce(max(rowid), 0) + 1 FROM ' + table).fetchone()[0]
+        finally:
+            connection.close()
+    return rowids
+
+def atomic(func, dbname=DBNAME, site=None):
+    '''
+    Run the given function in a single database transaction.
+
+    In a sharded database, the transaction is on the shard of 'site' if it is
+    given (see connect), otherwise on the catalog on its own.
+    '''
+    connection = connect(dbname, site)
     connection.text_factory = str # used to handle some unicode bugs
     db = ConnectionWrapper(connection)
     try:
         # ensures db closes
-        with connection:
-            # ensures transaction either aborts or commits
-            return func(db)
+        with TRANSACTION_SECONDS.time():
+            with connection:
+                # ensures transaction either aborts or commits
+                return func(db)
     finally:
         connection.close()
 
-def init(dbname=DBNAME):
+def init(dbname=DBNAME, sharded=None):
     '''
-    Initialize the database.
+    Initialize the database, sharded if it is new and 'sharded' (by default
+    SHARDED) is set.
+
+    If the database has already been initialized, this only creates the
+    tables and columns which it is missing (i.e. added since it was created),
+    in the catalog and in every shard of a sharded database.
     '''
+    if sharded is None:
+        sharded = SHARDED
+
     def work(db):
 
-        if db.query("""SELECT count(*) FROM sqlite_master WHERE type='table' AND name='RevisionTypes'""")[0] == 1 and db.query('SELECT count(*) FROM RevisionTypes')[0] == len(REVISION_TYPES):
-            print 'note: database has already been initialized!',
-            return
+        initialized = db.query("""SELECT count(*) FROM sqlite_master WHERE type='table' AND name='RevisionTypes'""")[0] == 1 and db.query('SELECT count(*) FROM RevisionTypes')[0] == len(REVISION_TYPES)
 
-        for statement in TABLE_SQL:
+        if sharded and db.query("SELECT count(*) FROM sqlite_master")[0] == 0:
+            db.query(SHARDS_SQL)
+        shards = _has_shards(db.connection)
+
+        # tables are only created if they are missing
+        _add_columns(db)
+        for statement in (CATALOG_TABLE_SQL if shards else TABLE_SQL):
             db.query(statement)
+
+        if initialized:
+            print 'note: database has already been initialized!',
+            return shards
+
         for revtype in REVISION_TYPES:
             db.query('INSERT INTO RevisionTypes VALUES (?,?)', REVISION_TYPES[revtype], revtype)
+        return shards
 
     # note: work is not really atomic; we're using a shortcut here
     # to reduce how much code we need to write
-    atomic(work, dbname)
+    # the catalog is used on its own, without the shards attached
+    connection = sqlite3.connect(dbname)
+    try:
+        with connection:
+            shards = work(ConnectionWrapper(connection))
+        sites = connection.execute('SELECT site FROM Shards').fetchall() if shards else []
+    finally:
+        connection.close()
+    _sharded.pop(dbname, None)
+
+    for (site,) in sites:
+        def update_shard(db):
+            _add_columns(db)
+            for statement in SITE_TABLE_SQL:
+                db.query(statement)
+        atomic(update_shard, dbname, site)
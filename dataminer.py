@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 
+import itertools
 import multiprocessing.pool
 import requests
 import os.path
+import random
+import tempfile
+import threading
+import time
+import traceback
+import urllib
 import database
 import fixlet_parser
+import metrics
+import throttle
 
 '''
 A text file where each line is a URL of a gather site to fetch from
@@ -17,15 +26,87 @@ Maximum number of tries to fetch a URL.
 '''
 FETCH_TRIES = 5
 
+'''
+Seconds to wait before the first retry of a URL. Each further retry waits up
+to twice as long (at random, so that failed requests do not all come back at
+once), up to FETCH_MAX_BACKOFF seconds.
+'''
+FETCH_BACKOFF = 0.5
+FETCH_MAX_BACKOFF = 30
+
+'''
+Limits of the number of requests to sync in flight at the same time. The
+number starts at FETCH_INITIAL_CONCURRENCY and adapts to how sync responds
+(see throttle.py): it grows while requests succeed in time and is halved when
+they fail (connection errors, 429 and 5xx) or take longer than
+FETCH_SLOW_SECONDS until the response headers arrive.
+'''
+FETCH_MIN_CONCURRENCY = 2
+FETCH_MAX_CONCURRENCY = 64
+FETCH_INITIAL_CONCURRENCY = 16
+FETCH_SLOW_SECONDS = 2
+
+'''
+Seconds between log lines with the current request limit and throughput.
+'''
+FETCH_LOG_INTERVAL = 60
+
 '''
 A cache of the output from finding all first fxf files.
 '''
 FIRST_FILE_CACHE = 'seed_cache.txt'
 
 '''
-Maximum number of threads to use while multiprocessing.
+A SQLite database of the versions of fixlet files which sync answered are
+missing (404), so that they are never requested again (see fetch_versioned).
+It is kept apart from DBNAME so that it outlives a database seeded from
+scratch.
+'''
+MISSING_CACHE = 'missing_cache.db'
+
+'''
+Maximum number of threads to use while multiprocessing. The requests they make
+are limited further by FETCH_MAX_CONCURRENCY and the adaptive limit below it.
+'''
+PROCESS_POOL_SIZE = FETCH_MAX_CONCURRENCY
+
+'''
+Number of worker processes used to parse fixlet files. Parsing is CPU-bound,
+so it is moved out of this interpreter to get around the GIL.
+Set to 0 to parse in the calling thread instead. Read when seed() or update()
+first starts the pools (see start_pools).
+'''
+PARSE_POOL_SIZE = multiprocessing.cpu_count()
+
+'''
+Whether to fetch the fixlet files of a site version out of the site's full-site
+archive (see FullSiteURL in the site metadata) instead of one file at a time.
+Files are still fetched individually when the archive is missing or cannot be
+unpacked.
+'''
+USE_FULLSITE = True
+
+'''
+Minimum number of files needed from a site version before its full-site
+archive is fetched. The archive holds every file of the site, so it is only
+worth downloading when many of them are needed.
+'''
+FULLSITE_MIN_FILES = 10
+
+'''
+Number of sites seeded at the same time. Each site's files are still fetched
+across the thread pool and parsed across the parse pool.
+'''
+SEED_SITE_WORKERS = 4
+
+'''
+Order in which update.py updates sites: 'largest' updates the site with the
+largest backlog (most expected requests, see plan_site_update) first and each
+site to completion before the next; 'round-robin' advances every site one
+version at a time in turn, so that no site falls far behind the others.
 '''
-PROCESS_POOL_SIZE = 32
+UPDATE_ORDERS = ('largest', 'round-robin')
+UPDATE_ORDER = 'largest'
 
 ### utilities
 
@@ -33,6 +114,10 @@ class MissingUrlException(Exception):
     '''Used by fetchurl() to indicate that it could not succeed.'''
     pass
 
+class NotFoundException(MissingUrlException):
+    '''Used by fetchurl() to indicate that the URL does not exist (404).'''
+    pass
+
 def maybe(func):
     '''Wraps a one-argument function so that if it's called with None, it returns None instead.'''
     def f(x):
@@ -42,34 +127,280 @@ def maybe(func):
             return func(x)
     return f
 
-def profile(func):
-    '''Wraps a function so that every time it's called, records and prints how long it takes'''
-    from datetime import datetime; now = datetime.now
-    def f(*args):
-        a = now()
-        ret = func(*args)
-        b = now()
-        print '{}{} finished w/ elapsed time: {}'.format(func, args, b-a)
-        return ret
-    return f
-
-@profile
-def fetchurl(url):
+### metrics (see metrics.py)
+
+FETCH_SECONDS = metrics.histogram('fetch_seconds', 'Latency of each HTTP request, per status code',
+                                  ('status',))
+FETCH_RETRIES = metrics.counter('fetch_retries_total', 'HTTP requests retried after a failed attempt')
+FETCH_FAILURES = metrics.counter('fetch_failures_total', 'URLs which could not be fetched')
+FETCH_BYTES = metrics.counter('fetch_bytes_total', 'Bytes of content fetched')
+FETCH_CONCURRENCY = metrics.gauge('fetch_concurrency_limit',
+                                  'Current limit of the requests in flight, see fetch_limit')
+FIRST_FXF_PROBES = metrics.counter('find_first_fxf_missing_total',
+                                   'Versions probed by find_first_fxf which did not exist')
+MISSING_AVOIDED = metrics.counter('missing_requests_avoided_total',
+                                  'Requests not made for fixlet file versions known to be missing')
+PARSE_SECONDS_PER_MB = metrics.histogram('parse_seconds_per_mb',
+                                         'Time spent parsing fixlet files, per MB of text')
+PARSE_BYTES = metrics.counter('parse_bytes_total', 'Bytes of fixlet files parsed')
+RUN_SECONDS = metrics.histogram('run_seconds', 'Duration of a whole seed or update',
+                                ('command',), buckets=(60, 300, 900, 3600, 4*3600, 12*3600))
+
+def fetchurl(url, stream=False):
     '''
     Try several times to fetch a URL and return its requests (see python module)
-    handle.
+    handle. If 'stream', the content of the response is left to be read from
+    the handle.
 
-    Throws MissingUrlException if it fails.
+    Throws MissingUrlException if it fails, NotFoundException if the URL
+    does not exist.
     '''
     for i in range(FETCH_TRIES):
+        if i > 0:
+            FETCH_RETRIES.inc()
+            time.sleep(random.uniform(0, min(FETCH_MAX_BACKOFF, FETCH_BACKOFF * 2**(i-1))))
+        start = fetch_limit.acquire()
         try:
-            r = requests.get(url)
-            if r.status_code == 200:
-                return r
+            r = requests.get(url, stream=stream)
         except Exception:
-            pass
+            r = None
+        if r is None:
+            fetch_limit.release(start, False)
+            FETCH_CONCURRENCY.set(fetch_limit.limit)
+            FETCH_SECONDS.observe(time.time() - start, status='error')
+            continue
+        # anything but 429 and 5xx is an answer from sync, even a 404
+        answered = r.status_code != 429 and r.status_code < 500
+        size = int(r.headers.get('content-length', 0)) if stream else len(r.content)
+        fetch_limit.release(start, answered, r.elapsed.total_seconds(), size)
+        FETCH_CONCURRENCY.set(fetch_limit.limit)
+        FETCH_SECONDS.observe(time.time() - start, status=r.status_code)
+        if r.status_code == 200:
+            FETCH_BYTES.inc(size)
+            return r
+        r.close()
+        if answered:
+            # e.g. missing, retrying would get the same answer
+            break
+    FETCH_FAILURES.inc()
+    if r is not None and r.status_code == 404:
+        raise NotFoundException('not found ' + url)
     raise MissingUrlException('cannot fetch ' + url)
 
+# site (url without version up to the file name, see _missing_site) -> set of
+# (url without version, version) of each file version of the site known to be
+# missing, each site loaded from MISSING_CACHE on first use
+missing_urls = {}
+# (url without version, version) found missing and not saved yet, see
+# save_missing
+unsaved_missing = []
+missing_urls_lock = threading.Lock()
+
+def _missing_key(url):
+    return strip_version(url), url_to_version(url)
+
+def _missing_site(url):
+    stripped = strip_version(url)
+    return stripped[:stripped.rfind('/')+1]
+
+def _create_missing_table(db):
+    db.query('CREATE TABLE IF NOT EXISTS MissingUrls (url text, version integer, primary key (url, version))')
+
+def site_missing(url):
+    '''
+    Returns the set of (url without version, version) of the file versions
+    known to be missing in the site of a versioned url. The caller must hold
+    missing_urls_lock.
+    '''
+    site = _missing_site(url)
+    if not site in missing_urls:
+        def load(db):
+            _create_missing_table(db)
+            # the urls of the site are those starting with 'site', which ends
+            # with a slash: the range up to the next character after it
+            return set(db.connection.execute(
+                'SELECT url, version FROM MissingUrls WHERE url>=? AND url<?',
+                (site, site[:-1] + chr(ord('/') + 1))))
+        missing_urls[site] = database.atomic(load, MISSING_CACHE)
+    return missing_urls[site]
+
+def known_missing(url):
+    '''
+    Returns whether a versioned url (of a fixlet file or full-site archive) is
+    known to be missing.
+    '''
+    with missing_urls_lock:
+        return _missing_key(url) in site_missing(url)
+
+def known_missing_versions(url):
+    '''
+    Returns the set of versions known to be missing of the file of a
+    versioned url.
+    '''
+    stripped = strip_version(url)
+    with missing_urls_lock:
+        return set(version for other, version in site_missing(url) if other == stripped)
+
+def record_missing(url):
+    '''
+    Remembers that a versioned url is missing, see known_missing. It is only
+    written to MISSING_CACHE by the next save_missing.
+    '''
+    key = _missing_key(url)
+    with missing_urls_lock:
+        if not key in site_missing(url):
+            site_missing(url).add(key)
+            unsaved_missing.append(key)
+
+def save_missing():
+    '''
+    Writes the urls found missing since the last call to MISSING_CACHE, in one
+    transaction. Called once the work of a file or site is committed, so that
+    fetching threads never wait on it.
+    '''
+    global unsaved_missing
+    with missing_urls_lock:
+        keys, unsaved_missing = unsaved_missing, []
+    if len(keys) == 0:
+        return
+    def save(db):
+        _create_missing_table(db)
+        db.query_many('INSERT OR IGNORE INTO MissingUrls VALUES (?,?)', keys)
+    try:
+        database.atomic(save, MISSING_CACHE)
+    except Exception as e:
+        # kept for the next try, they are only an optimization
+        print 'note: could not save {} missing urls ({})'.format(len(keys), e)
+        with missing_urls_lock:
+            unsaved_missing.extend(keys)
+
+def fetch_versioned(url, stream=False):
+    '''
+    Fetch a versioned url (of a fixlet file or full-site archive) like
+    fetchurl, unless it is known to be missing: versioned files never change,
+    so a file which sync once answered is missing is never requested again.
+
+    Throws MissingUrlException if it fails or is missing.
+    '''
+    if known_missing(url):
+        MISSING_AVOIDED.inc()
+        raise NotFoundException('known to be missing ' + url)
+    try:
+        return fetchurl(url, stream)
+    except NotFoundException:
+        record_missing(url)
+        raise
+
+def fetch_fxf_text(url):
+    '''
+    Fetch a fixlet file and return its decoded text.
+
+    Throws MissingUrlException if it fails.
+    '''
+    fxf_handle = fetch_versioned(url)
+    fxf_handle.encoding = 'windows-1252'
+    return fxf_handle.text
+
+def parse_fxf_text(fxf_text):
+    '''
+    Parse the text of a fixlet file into a list of fixlet_parser.FixletRow,
+    using the parse pool when there is one.
+    '''
+    start = time.time()
+    if parse_pool is None:
+        rows = fixlet_parser.parse_fxffile_rows(fxf_text)
+    else:
+        rows = parse_pool.apply(fixlet_parser.parse_fxffile_rows, (fxf_text,))
+    if len(fxf_text) > 0:
+        PARSE_SECONDS_PER_MB.observe((time.time() - start) / (len(fxf_text) / 2.0**20))
+    PARSE_BYTES.inc(len(fxf_text))
+    return rows
+
+def fetch_and_parse_fxf(url, fetch=fetch_fxf_text):
+    '''
+    Fetch and parse a fixlet file, using 'fetch' to get the text of the file
+    (see fetch_fxf_text). Returns a tuple
+    (text of the file, list of fixlet_parser.FixletRow).
+    '''
+    fxf_text = fetch(url)
+    return fxf_text, parse_fxf_text(fxf_text)
+
+# full-site urls (without version) of the sites whose full-site archive could
+# not be unpacked, so that it is not downloaded again for every version
+unusable_fullsites = set()
+
+def fetch_to_file(url):
+    '''
+    Fetch a versioned url like fetch_versioned, streaming its content into a
+    temporary file, and return the file.
+    '''
+    r = fetch_versioned(url, stream=True)
+    f = tempfile.TemporaryFile()
+    try:
+        for chunk in r.iter_content(2**16):
+            f.write(chunk)
+    except:
+        f.close()
+        raise
+    finally:
+        r.close()
+    f.seek(0)
+    return f
+
+def fullsite_fetcher(fullsite_url, version):
+    '''
+    Given the full-site url of a site (at any version), downloads the
+    full-site archive of the site at 'version'. Returns a function which
+    behaves like fetch_fxf_text for fixlet files of that version but reads
+    them out of the archive, and fetches any file not in the archive with
+    fetch_fxf_text.
+
+    If the archive cannot be fetched, returns fetch_fxf_text. If it cannot be
+    unpacked, the archives of the site are not used again.
+    '''
+    site_url = strip_version(fullsite_url)
+    if site_url in unusable_fullsites:
+        return fetch_fxf_text
+    url = add_version(site_url, version)
+    try:
+        site = fixlet_parser.parse_fullsite(fetch_to_file(url))
+    except MissingUrlException as e:
+        print 'note: fetching files individually, could not fetch {} ({})'.format(url, e)
+        return fetch_fxf_text
+    except Exception as e:
+        print 'note: fetching files of {} individually, could not unpack {} ({!r})'.format(
+            site_url, url, e)
+        unusable_fullsites.add(site_url)
+        return fetch_fxf_text
+
+    def fetch(fxf_url):
+        try:
+            contents = site.read(urllib.unquote(url_to_fxf_name(fxf_url)))
+        except Exception as e:
+            print 'note: fetching {} individually, could not read it out of {} ({!r})'.format(
+                fxf_url, url, e)
+            contents = None
+        if contents is None:
+            return fetch_fxf_text(fxf_url)
+        return contents.decode('windows-1252', 'replace')
+    return fetch
+
+def site_fetcher(fullsite_url, version, needed):
+    '''
+    Returns the function to fetch 'needed' fixlet files of some site version
+    with: a fullsite_fetcher if it is worth downloading the site's full-site
+    archive, otherwise fetch_fxf_text. This never raises: whatever goes wrong
+    with the archive, files are fetched individually.
+    '''
+    if USE_FULLSITE and fullsite_url is not None and needed >= FULLSITE_MIN_FILES:
+        try:
+            return fullsite_fetcher(fullsite_url, version)
+        except Exception:
+            print 'note: fetching files individually, could not use the full-site archive of {}:'.format(
+                fullsite_url)
+            traceback.print_exc()
+    return fetch_fxf_text
+
 def url_to_version(url):
     '''
     Given some url corresponding to a fixlet file, this returns the version
@@ -109,6 +440,35 @@ def add_version(url, version):
     slash = url.rfind('/')
     return url[:slash] + '_' + str(version) + url[slash:]
 
+def url_to_fxf_name(url):
+    '''
+    Given some url corresponding to a fixlet file, this returns the name of
+    the file as it is recorded in the database.
+
+    e.g.
+    url_to_fxf_name("http://sync.bigfix.com/bfsites/aixpatches_382/52.fxf")
+    becomes
+    "52"
+    '''
+    return url[url.rfind('/')+1:-4]
+
+def site_property(properties, name):
+    '''
+    Given a site's metadata (as returned by parse_site_metadata), returns the
+    value of the first property with the given name, or None if it is missing.
+    '''
+    for key, value in properties:
+        if key == name:
+            return value
+    return None
+
+def site_version(properties):
+    '''
+    Given a site's metadata (as returned by parse_site_metadata), returns the
+    version of the site that is currently published, or None if it is unknown.
+    '''
+    return maybe(int)(site_property(properties, 'Version'))
+
 ### operations used for initialization re. sites
 
 '''
@@ -243,9 +603,10 @@ def find_first_fxf(url):
     url = url.replace('_{}/'.format(str(version)), '_1/')
     while attempting <= version:
         try:
-            handle = fetchurl(url)
+            handle = fetch_versioned(url)
             return (attempting, url)
         except MissingUrlException:
+            FIRST_FXF_PROBES.inc()
             url = url.replace('_{}/'.format(str(attempting)), '_{}/'.format(str(attempting+1)))
             attempting += 1
     return None # TODO assert something wrong happened here?
@@ -292,82 +653,464 @@ def create_application_seed(short_names, urls, site_roots, metadata):
      match up with the same site),
 
     this initializes the application seed (the database).
+
+    Up to SEED_SITE_WORKERS sites are seeded at the same time (see
+    initialize_site). A site which fails is reported and left out without
+    affecting any other site.
     '''
     database.init()
-    for site in zip(short_names, urls, site_roots, metadata):
+    sites = [site for site in zip(short_names, urls, site_roots, metadata)
+             if not site[2] is None]
+
+    def seed_site(site):
         name, url, fxffiles, meta = site
-        if not fxffiles is None:
-            database.atomic(lambda db: initialize_site(db, name, url, fxffiles, meta))
+        try:
+            initialize_site(name, url, fxffiles, meta)
+        except Exception as e:
+            print 'Could not seed site {}! Details:'.format(name)
+            traceback.print_exc()
+
+    # a pool of its own, since seed_site waits on the shared pool
+    site_pool = multiprocessing.pool.ThreadPool(processes=SEED_SITE_WORKERS)
+    try:
+        site_pool.map(seed_site, sites, chunksize=1)
+    finally:
+        site_pool.close()
+        site_pool.join()
 
-def initialize_site(db, site_name, site_url, fxffiles, metadata):
+def initialize_site(site_name, site_url, fxffiles, metadata):
     '''
     Given a site's name, url,
     a list of (version, url) pairs returned by find_first_fxf,
     and site metadata, initializes in the database:
 
     1) The site entry in the database table Sites
-    2) The fixlet files and their contents
+    2) The fixlet files and their contents (entries of 'fxffiles' which are
+       None, i.e. files whose first version was not found, are left out)
     3) The fixlets corresponding to these files and their contents
+
+    The site entry is committed first, then each fixlet file is committed
+    together with its fixlets in a transaction of its own (see
+    initialize_fxffiles). Returns the number of files which failed; they are
+    left out, and the next update adds them as new files.
     '''
 
     # initialize the site
-    db.query("INSERT INTO Sites VALUES (?,?)", site_name, site_url)
-    site_id = db.cursor.lastrowid
+    def insert_site(db):
+        db.query("INSERT INTO Sites VALUES (?,?)", site_name, site_url)
+        return db.cursor.lastrowid
+    with write_lock(None):
+        site_id = database.atomic(insert_site)
+    fullsite_url = maybe(lambda meta: site_property(meta, 'FullSiteURL'))(metadata)
+
+    # a file whose first version could not be found (see find_first_fxf)
+    # counts as failed
+    failed = len([fxffile for fxffile in fxffiles if fxffile is None])
+    if failed > 0:
+        print 'Could not find the first version of {} files of site {}!'.format(failed, site_name)
+
+    # files are handled one version at a time so that at most one
+    # full-site archive is held at once
+    fxffiles = sorted(fxffile for fxffile in fxffiles if fxffile is not None)
+    for version, group in itertools.groupby(fxffiles, lambda fxffile: fxffile[0]):
+        group = list(group)
+        fetch = site_fetcher(fullsite_url, version, len(group))
+        failed += initialize_fxffiles(site_id, group, fetch)
+
+    print 'Seeded site {} (id {}), {} files failed.'.format(site_name, site_id, failed)
+    return failed
+
+def initialize_fxffiles(site_id, fxffiles, fetch):
+    '''
+    Given a site's id and a list of (version, url) pairs returned by
+    find_first_fxf, initializes the fixlet files and their fixlets in the
+    database, using 'fetch' to get the text of each file. Each file is
+    written in its own transaction. Returns the number of files which could
+    not be fetched, parsed or written.
+    '''
 
-    for fxffile in fxffiles:
-        version, fxf_url = fxffile
+    def fetch_and_parse(fxffile):
+        try:
+            return fetch_and_parse_fxf(fxffile[1], fetch)
+        except Exception as e:
+            return e
 
-        # turns the url http://.../<fixlet-name>.fxf to <fixlet-name>
-        fxf_name = fxf_url[fxf_url.rfind('/')+1:-4]
+    # fetch and parse files ahead of the writes below: fetching is spread
+    # across the thread pool and parsing across the parse pool
+    fetched = pool.imap(fetch_and_parse, fxffiles)
 
-        # initialize the .fxf file
-        db.query('INSERT INTO FxfFiles VALUES (?,?,?,?)', site_id, version, version, fxf_name)
-        fxf_id = db.cursor.lastrowid
-        db.query('INSERT INTO FxfRevisions VALUES (?,?,?,?)', fxf_id, version,
-                 database.revtype('new'), fxf_url)
-        fxf_revision_id = db.cursor.lastrowid
+    failed = 0
+    for fxffile, parsed in itertools.izip(fxffiles, fetched):
+        try:
+            if isinstance(parsed, Exception):
+                raise parsed
+            with write_lock(site_id):
+                database.atomic(lambda db: insert_fxffile(db, site_id, fxffile, parsed),
+                                site=site_id)
+        except Exception as e:
+            print 'Could not seed file {}! Details: {}'.format(fxffile[1], e)
+            failed += 1
+        save_missing()
+    return failed
 
-        # fetch contents of the file and initialize that
-        fxf_handle = fetchurl(fxf_url)
-        fxf_handle.encoding = 'windows-1252'
-        fxf_text = fxf_handle.text
-        db.query('INSERT INTO FxfContents VALUES (?,?)', fxf_revision_id, fxf_text)
+def insert_fxffile(db, site_id, fxffile, parsed):
+    '''
+    Given a site's id, a (version, url) pair returned by find_first_fxf and
+    the (text, fixlets) of the file returned by fetch_and_parse_fxf, inserts
+    the fixlet file and its fixlets.
+    '''
+    version, fxf_url = fxffile
+    fxf_text, fixlets = parsed
+    fxf_name = url_to_fxf_name(fxf_url)
 
-        # parse the fixlets per file
-        fixlets = fixlet_parser.parse_fxffile(fxf_text)
+    # initialize the .fxf file
+    db.query('INSERT INTO FxfFiles VALUES (?,?,?,?)', site_id, version, version, fxf_name)
+    fxf_id = db.cursor.lastrowid
+    db.query('INSERT INTO FxfRevisions VALUES (?,?,?,?)', fxf_id, version,
+             database.revtype('new'), fxf_url)
+    fxf_revision_id = db.cursor.lastrowid
+
+    # initialize the contents of the file
+    db.query('INSERT INTO FxfContents VALUES (?,?)', fxf_revision_id, fxf_text)
+
+    for fixlet in fixlets:
+        # record the fixlet and its contents
+        insert_revision(db, site_id, fixlet, version, database.revtype('new'), fxf_revision_id)
 
-        for fixlet_id in fixlets:
-            fixlet = fixlets[fixlet_id]
+def insert_revision(db, site_id, fixlet, version, revision_type, fxf_revision_id):
+    '''
+    Records a revision of a fixlet (as returned by parse_fxf_text) at some
+    version, together with its contents, and returns its id.
 
-            # record the fixlet and its contents
-            db.query('INSERT INTO Revisions VALUES (?,?,?,?,?,?,?)', site_id, fixlet_id, version,
-                     database.revtype('new'), fixlet.modified, fixlet.title, fxf_revision_id)
-            fixlet_revision_id = db.cursor.lastrowid
-            db.query('INSERT INTO RevisionContents VALUES (?,?)',
-                     fixlet_revision_id, fixlet.contents)
+    The revision is valid until the version of the next revision of the
+    fixlet if there is one, otherwise forever (database.VALID_FOREVER), and
+    the previous revision of the fixlet becomes valid only until this one.
+    '''
+    valid_to = db.query('SELECT min(version) FROM Revisions WHERE site=? AND fixlet_id=? AND version>?',
+                        site_id, fixlet.fid, version)[0]
+    if valid_to is None:
+        valid_to = database.VALID_FOREVER
+    db.query('UPDATE Revisions SET valid_to=? WHERE site=? AND fixlet_id=? AND version<? AND valid_to>?',
+             version, site_id, fixlet.fid, version, version)
+    db.query('INSERT INTO Revisions VALUES (?,?,?,?,?,?,?,?,?)', site_id, fixlet.fid, version,
+             revision_type, fixlet.modified, fixlet.title, fxf_revision_id, version, valid_to)
+    revision_id = db.cursor.lastrowid
+    db.query('INSERT INTO RevisionContents VALUES (?,?)', revision_id, fixlet.contents)
+    return revision_id
+
+def write_lock(site_id):
+    '''
+    Returns the lock serializing writes to the database file holding a site's
+    data (the catalog if 'site_id' is None), so that sites seeded at the same
+    time take turns rather than time out waiting for SQLite's write lock.
+    Sites of a sharded database (see database.SHARDED) have a lock each.
+    '''
+    key = site_id if site_id is not None and database.sharded() else None
+    return write_locks.setdefault(key, threading.Lock())
 
 ### database operations - updating
 
-def update_application_database(metadata, added_fxffiles):
+def outdated_sites(metadata):
+    '''
+    Given site metadata, returns a dictionary from the name of every site
+    whose published version was not fully processed by an earlier update to
+    a tuple (site id, published version).
     '''
-    Updates the application database given site metadata and a list of added
-    .fxf files. Does this by doing the following:
+    outdated = {}
+    for site_id, site_name, processed_version in database.atomic(site_list):
+        if metadata.get(site_name) is None:
+            continue
+        to_version = site_version(metadata[site_name])
+        if to_version is None:
+            print 'Could not find the version of site {}!'.format(site_name)
+        elif to_version == processed_version:
+            print 'Site {} is already up to date (version {}).'.format(site_name, to_version)
+        else:
+            outdated[site_name] = (site_id, to_version)
+    return outdated
+
+def update_application_database(metadata, added_fxffiles, directories, order=UPDATE_ORDER):
+    '''
+    Updates the application database given site metadata, a list of added
+    .fxf files and the current directory of each site.
+
+    Sites whose published version was already fully processed by an earlier
+    update are skipped. For every other site, this does the following:
     1) If any fxf files which were previously not tracked were added to some
-    publication of a site, saves them to the database.
-    2) For each fxf file this updates it to the latest version.
+    publication of the site, saves them to the database.
+    2) Records the directory of the site, bumping the version of each fxf
+    file which did not change since the last recorded directory.
+    3) Updates each of the site's fxf files to the latest version, and if
+    all of them succeed, records the site as processed at that version.
+
+    Sites are updated in the given order (see UPDATE_ORDER).
     '''
-    save_added_fxffiles(added_fxffiles)
+    outdated = outdated_sites(metadata)
+    plans = plan_update(outdated, metadata, directories)
+
+    save_added_fxffiles(dict((site_name, added_fxffiles[site_name])
+                             for site_name in added_fxffiles if site_name in outdated))
+
+    walks = []
+    for plan in order_site_plans(plans, order):
+        site_id, to_version = plan['site_id'], plan['to_version']
+        if directories.get(plan['site']) is not None:
+            database.atomic(lambda db: record_site_directory(db, site_id, to_version,
+                                                             directories[plan['site']]),
+                            site=site_id)
+        failed = set()
+        walks.append((plan, failed, update_site(site_id, to_version, plan['fullsite_url'], failed)))
+
+    def finish(plan, failed):
+        print 'Updated site (id {}) to version {}, {} files failed.'.format(
+            plan['site_id'], plan['to_version'], len(failed))
+        if len(failed) == 0:
+            database.atomic(lambda db: db.query('INSERT OR REPLACE INTO SiteVersions VALUES (?,?)',
+                                                plan['site_id'], plan['to_version']))
+
+    if order == 'round-robin':
+        # advance every site by one version in turn
+        while len(walks) > 0:
+            for walk in list(walks):
+                plan, failed, versions = walk
+                if next(versions, None) is None:
+                    finish(plan, failed)
+                    walks.remove(walk)
+    else:
+        for plan, failed, versions in walks:
+            for version in versions:
+                pass
+            finish(plan, failed)
 
-    for fxf in database.atomic(fxffile_list):
-        try:
-            to_version = int(database.atomic(lambda db: latest_published_version(db, fxf, metadata)))
-            database.atomic(lambda db: update_fxffile(db, fxf, to_version))
-            print 'Successfully updated file (id {}).'.format(fxf[0])
-        except Exception as e:
-            import traceback
-            print 'Could not update file (id {})! Details:'.format(fxf[0])
-            traceback.print_exc()
-            # import pdb; pdb.set_trace()
+def update_site(site_id, to_version, fullsite_url, failed):
+    '''
+    Updates every fxf file of a site to 'to_version', adding the id of every
+    file which fails to update to the set 'failed'. This is a generator which
+    yields each site version once it is done, so that the updates of several
+    sites can be interleaved.
+
+    Files are walked one site version at a time, so that every file needing
+    some version can be fetched out of one full-site archive. The files of a
+    version are fetched and parsed ahead, and each is then updated to that
+    version in its own transaction; a file which fails to update is left
+    alone for the rest of the walk.
+    '''
+    from_version = database.atomic(
+        lambda db: db.query('SELECT min(latest) FROM FxfFiles WHERE site=?', site_id)[0], site=site_id)
+    if from_version is None:
+        return
+
+    for version in range(from_version+1, to_version+1):
+        fxffiles = database.atomic(lambda db: outdated_fxffile_list(db, site_id, version),
+                                   site=site_id)
+        fxffiles = [fxf for fxf in fxffiles if not fxf[0] in failed]
+        if len(fxffiles) == 0:
+            continue
+
+        fetch = site_fetcher(fullsite_url, version, len(fxffiles))
+
+        def fetch_and_parse(fxf):
+            try:
+                fxf_url, current_content = database.atomic(
+                    lambda db: current_fxffile(db, fxf), site=site_id)
+                fxf_text = fetch(add_version(strip_version(fxf_url), version))
+                if fxf_text == current_content:
+                    return fxf_text, None
+                return fxf_text, parse_fxf_text(fxf_text)
+            except Exception as e:
+                return e
+
+        # fetch and parse the files of this version ahead of the writes below:
+        # fetching is spread across the thread pool and parsing across the
+        # parse pool
+        fetched = pool.imap(fetch_and_parse, fxffiles)
+
+        for fxf, parsed in itertools.izip(fxffiles, fetched):
+            try:
+                database.atomic(lambda db: update_fxffile(db, fxf, version, *prefetched(parsed)),
+                                site=site_id)
+            except Exception as e:
+                print 'Could not update file (id {})! Details:'.format(fxf[0])
+                traceback.print_exc()
+                failed.add(fxf[0])
+        save_missing()
+        yield version
+
+def prefetched(parsed):
+    '''
+    Given the (text, fixlets or None if unchanged) of a file of some version,
+    or the exception raised getting them, returns the functions to pass as
+    'fetch' and 'parse' to update_fxffile to update the file to that version.
+    '''
+    def fetch(fxf_url):
+        if isinstance(parsed, Exception):
+            raise parsed
+        return parsed[0]
+    def parse(fxf_text):
+        if parsed[1] is None:
+            return parse_fxf_text(fxf_text)
+        return parsed[1]
+    return fetch, parse
+
+### update planning
+
+def plan_update(outdated, metadata, directories):
+    '''
+    Given the outdated sites (as returned by outdated_sites), their metadata
+    and their current directories, returns a list of plans as returned by
+    plan_site_update. Each site is planned in a transaction of its own.
+    '''
+    return [database.atomic(lambda db: plan_site_update(db, site_name, site_id, to_version,
+                                                        metadata[site_name],
+                                                        directories.get(site_name)),
+                            site=site_id)
+            for site_name, (site_id, to_version) in sorted(outdated.iteritems())]
+
+def plan_site_update(db, site_name, site_id, to_version, properties, directory):
+    '''
+    Estimates the work needed to update a site to 'to_version' without
+    fetching any fixlet file, following the same steps as
+    update_application_database: files which did not change since the last
+    recorded directory are bumped for free, then every other file is fetched
+    once per version it is behind, or out of the full-site archive (see
+    site_fetcher). Sizes are taken from the current directory, so bytes are an
+    estimate. Added files are counted as found by the first probe of
+    find_first_fxf and fetched again; the probes of earlier versions are
+    unknown, so their worst case (every version before the current one which
+    is not known to be missing, see known_missing_versions) is reported on its
+    own as 'added_probe_upper_bound' and left out of 'requests'.
+
+    Returns a dictionary describing the site with a list of its outdated
+    files:
+    {'site': site_name, 'site_id': site_id, 'to_version': to_version,
+     'fullsite_url': ..., 'behind': most versions behind of any file,
+     'requests': ..., 'bytes': ..., 'fullsite_requests': ..., 'fullsite_bytes': ...,
+     'added_files': ..., 'added_requests': ..., 'added_bytes': ...,
+     'added_probe_upper_bound': ...,
+     'files': [{'id':, 'name':, 'latest':, 'disk_latest':, 'behind':,
+                'requests':, 'bytes':}, ...]}
+    '''
+    fullsite_url = site_property(properties, 'FullSiteURL')
+    entries = {} # fxf name -> (size, hash)
+    urls = {} # fxf name -> url
+    for entry in directory or []:
+        entries[url_to_fxf_name(entry['url'])] = (int(entry['size']), entry['hash'])
+        urls[url_to_fxf_name(entry['url'])] = entry['url']
+
+    old_version = db.query('SELECT max(version) FROM GatherEntries WHERE site=? AND version<?',
+                           site_id, to_version)[0]
+    old_hashes = {}
+    generator = db.query_generator('SELECT name, hash FROM GatherEntries WHERE site=? AND version=?',
+                                   site_id, old_version)
+    while generator.has_next():
+        name, fxf_hash = generator.pop()
+        old_hashes[name] = fxf_hash
+
+    files = []
+    tracked = set()
+    generator = db.query_generator('SELECT rowid, latest, disk_latest, name FROM FxfFiles WHERE site=?',
+                                   site_id)
+    while generator.has_next():
+        fxffile_id, latest, disk_latest, name = generator.pop()
+        tracked.add(name)
+        size, fxf_hash = entries.get(name, (0, None))
+        if latest == old_version and fxf_hash is not None and old_hashes.get(name) == fxf_hash:
+            latest = to_version # bumped by record_site_directory
+        if latest < to_version:
+            files.append({'id': fxffile_id, 'name': name, 'latest': latest,
+                          'disk_latest': disk_latest, 'behind': to_version - latest,
+                          'size': size, 'requests': 0, 'bytes': 0})
+
+    fullsite_requests = fullsite_bytes = 0
+    site_size = sum(size for size, fxf_hash in entries.itervalues())
+    first_version = min([fxf['latest'] for fxf in files] or [to_version])
+    for version in range(first_version+1, to_version+1):
+        needed = [fxf for fxf in files if fxf['latest'] < version]
+        if USE_FULLSITE and fullsite_url is not None and len(needed) >= FULLSITE_MIN_FILES:
+            fullsite_requests += 1
+            fullsite_bytes += site_size
+        else:
+            for fxf in needed:
+                fxf['requests'] += 1
+                fxf['bytes'] += fxf['size']
+
+    added = [name for name in entries if not name in tracked]
+    # found by one probe and fetched again
+    added_requests = 2 * len(added)
+    added_bytes = 2 * sum(entries[name][0] for name in added)
+    # at worst, every earlier version is probed first
+    added_probe_upper_bound = 0
+    for name in added:
+        missing = known_missing_versions(urls[name])
+        added_probe_upper_bound += len([version for version in range(1, to_version)
+                                        if not version in missing])
+
+    return {'site': site_name, 'site_id': site_id, 'to_version': to_version,
+            'fullsite_url': fullsite_url,
+            'behind': max([fxf['behind'] for fxf in files] or [0]),
+            'requests': fullsite_requests + added_requests + sum(fxf['requests'] for fxf in files),
+            'bytes': fullsite_bytes + added_bytes + sum(fxf['bytes'] for fxf in files),
+            'fullsite_requests': fullsite_requests, 'fullsite_bytes': fullsite_bytes,
+            'added_files': len(added), 'added_requests': added_requests,
+            'added_bytes': added_bytes, 'added_probe_upper_bound': added_probe_upper_bound,
+            'files': sorted(files, key=lambda fxf: (-fxf['behind'], fxf['name']))}
+
+def order_site_plans(plans, order=UPDATE_ORDER):
+    '''
+    Returns the site plans (see plan_site_update) in the order their sites
+    should be updated: the largest backlog (most expected requests, leaving out
+    the worst case of probing for added files) first. With 'round-robin'
+    order, the sites are then advanced one version at a time in turn rather
+    than one after another (see update_application_database).
+    '''
+    if not order in UPDATE_ORDERS:
+        raise ValueError('unknown update order: ' + str(order))
+    return sorted(plans, key=lambda plan: (-plan['requests'], plan['site']))
+
+def print_update_plan(plans, order=UPDATE_ORDER, show_files=False):
+    '''
+    Prints the site plans (see plan_site_update) in update order, with their
+    outdated files if 'show_files' is set, followed by the totals.
+    '''
+    plans = order_site_plans(plans, order)
+    print '{:<30} {:>8} {:>8} {:>8} {:>6} {:>10} {:>10}'.format(
+        'site', 'version', 'behind', 'files', 'added', 'requests', 'MB')
+    for plan in plans:
+        print '{:<30} {:>8} {:>8} {:>8} {:>6} {:>10} {:>10.2f}'.format(
+            plan['site'], plan['to_version'], plan['behind'], len(plan['files']),
+            plan['added_files'], plan['requests'], plan['bytes'] / 2.0**20)
+        if plan['fullsite_requests'] > 0:
+            print '    {:<26} {:>44} {:>10.2f}'.format(
+                '(full-site archives)', plan['fullsite_requests'],
+                plan['fullsite_bytes'] / 2.0**20)
+        if plan['added_probe_upper_bound'] > 0:
+            print '    {:<26} {:>44}'.format('(added file probes, at most)',
+                                           plan['added_probe_upper_bound'])
+        if show_files:
+            for fxf in plan['files']:
+                print '    {:<26} {:>8} {:>8} {:>35} {:>10.2f}'.format(
+                    fxf['name'], fxf['latest'], fxf['behind'], fxf['requests'],
+                    fxf['bytes'] / 2.0**20)
+    print '{} sites, {} outdated files, about {} requests (and at most {} probes for added files) and {:.2f} MB'.format(
+        len(plans), sum(len(plan['files']) for plan in plans),
+        sum(plan['requests'] for plan in plans),
+        sum(plan['added_probe_upper_bound'] for plan in plans),
+        sum(plan['bytes'] for plan in plans) / 2.0**20)
+
+def site_list(db):
+    '''
+    Returns a list of all sites in the database.
+
+    This is a list of tuples in the format
+    (site_id, site name, last fully processed version or None)
+    '''
+    sites = []
+    generator = db.query_generator('''
+SELECT S.rowid, S.name, V.version
+FROM Sites S LEFT JOIN SiteVersions V ON V.site = S.rowid''')
+    while generator.has_next():
+        sites.append(generator.pop())
+    return sites
 
 def fxffile_list(db):
     '''
@@ -377,53 +1120,79 @@ def fxffile_list(db):
     (fxffile_id, site, fxffile_version, fxffile_disk_version, fxffile_source_url)
     '''
     files = []
-    generator = db.query_generator('SELECT rowid, * FROM FxfFiles')
+    generator = db.query_generator('SELECT rowid, site, latest, disk_latest, name FROM FxfFiles')
     while generator.has_next():
         files.append(generator.pop())
     return files
 
-def latest_published_version(db, fxf, metadata):
+def outdated_fxffile_list(db, site_id, version):
     '''
-    Given a fixlet file datum (a tuple returned by fxffile_list),
-    returns the latest version of that file.
+    Returns a list of the fixlet files of a site whose latest version is
+    older than 'version', in the same format as fxffile_list.
     '''
-    _, site, _, _, _ = fxf
-    site_name = db.query('SELECT Sites.name FROM Sites WHERE rowid=?', site)[0]
-    for pair in metadata[site_name]:
-        if pair[0] == 'Version':
-            return pair[1] # TODO cast to int?
-    raise Exception('TODO need to use more robust version-finding')
+    files = []
+    generator = db.query_generator('''
+SELECT rowid, site, latest, disk_latest, name FROM FxfFiles WHERE site=? AND latest<?''',
+                                   site_id, version)
+    while generator.has_next():
+        files.append(generator.pop())
+    return files
+
+def record_site_directory(db, site_id, version, directory):
+    '''
+    Given a site's id, its current version and its directory at that
+    version (as returned by to_site_directories), records the directory in
+    the database.
+
+    Every fixlet file which has the same hash in the previously recorded
+    directory of the site and which is up to date with that directory is then
+    known not to have changed, so its latest version is bumped to 'version'
+    without fetching it. Returns the number of files bumped.
+    '''
+    db.query_many('INSERT OR REPLACE INTO GatherEntries VALUES (?,?,?,?,?)',
+                  [(site_id, version, url_to_fxf_name(entry['url']),
+                    int(entry['size']), entry['hash'])
+                   for entry in directory])
+
+    old_version = db.query('SELECT max(version) FROM GatherEntries WHERE site=? AND version<?',
+                           site_id, version)[0]
+    if old_version is None:
+        return 0
+
+    db.query('''
+UPDATE FxfFiles SET latest=?
+WHERE site=? AND latest=? AND name IN (
+  SELECT O.name
+  FROM GatherEntries O, GatherEntries N
+  WHERE O.site=N.site AND O.name=N.name AND O.hash=N.hash
+    AND O.site=? AND O.version=? AND N.version=?)''',
+             version, site_id, old_version, site_id, old_version, version)
+    return db.cursor.rowcount
 
 def disk_site_directories():
     '''
     Reads the database and returns a set of fixlet files tracked for
-    each site in the db.
+    each site in the db. Sites are read one at a time (in a sharded
+    database, each out of its own file).
     '''
 
-    def query_directories(db):
+    def query_directory(db, site_id):
         generator = db.query_generator('''
-    SELECT S.rowid as site_id, group_concat(F.url) as fixlet_urls
-    FROM Sites S LEFT JOIN
-    (
-        SELECT FF.site as site, FR.source_url as url
-        FROM FxfFiles FF, FxfRevisions FR
-        WHERE FR.fxf = FF.rowid AND FR.version = FF.disk_latest
-    ) F
-    ON F.site = S.rowid
-    GROUP BY S.rowid
-    ORDER BY S.rowid''')
-        directories = []
+    SELECT FR.source_url
+    FROM FxfFiles FF, FxfRevisions FR
+    WHERE FR.fxf = FF.rowid AND FR.version = FF.disk_latest AND FF.site = ?''', site_id)
+        urls = set()
         while generator.has_next():
-            row = generator.pop()
-            if row[1] == None:
-                continue
-
-            urls = set(row[1].split(','))
-            urls = map(strip_version, urls)
-            directories.append(urls)
-        return directories
+            urls.add(generator.pop()[0])
+        return urls
 
-    return database.atomic(query_directories)
+    directories = []
+    for site_id, site_name, processed_version in database.atomic(site_list):
+        urls = database.atomic(lambda db: query_directory(db, site_id), site=site_id)
+        if len(urls) == 0:
+            continue
+        directories.append(map(strip_version, urls))
+    return directories
 
 def find_added_fxffiles(site_names, old_directories, new_directories):
     '''
@@ -480,8 +1249,22 @@ def save_added_fxffiles(added_fxffiles):
     first_files = pool.map(find_first_fxf, added) # list of (version, url) pairs
 
     # initialize each file in the database
-    insert = lambda newfile: database.atomic(lambda db: insert_new_fxffile(db, newfile))
+    site_ids = dict((site_name, site_id) for site_id, site_name, version in database.atomic(site_list))
+    # a file which cannot be found or inserted is left out, and tried again
+    # by the next update
+    def insert(newfile):
+        site_name, first_file = newfile
+        if first_file is None:
+            print 'Could not find the first version of a new file of site {}!'.format(site_name)
+            return False
+        try:
+            return database.atomic(lambda db: insert_new_fxffile(db, newfile),
+                                   site=site_ids[site_name])
+        except Exception as e:
+            print 'Could not add file {}! Details: {}'.format(first_file[1], e)
+            return False
     success = map(insert, zip(sites, first_files))
+    save_missing()
     return success
 
 def insert_new_fxffile(db, newfile):
@@ -493,9 +1276,7 @@ def insert_new_fxffile(db, newfile):
     # TODO this code is really similar to initialize_site - fix redundancies?
     site_name, version_info = newfile
     version, fxf_url = version_info
-    
-    # turns the url http://.../<fixlet-name>.fxf to <fixlet-name>
-    fxf_name = fxf_url[fxf_url.rfind('/')+1:-4] # .../<fixlet-name>.fxf
+    fxf_name = url_to_fxf_name(fxf_url)
 
     # insert .fxf data
     site_id = db.query('SELECT rowid FROM Sites WHERE name=?', site_name)[0]
@@ -505,46 +1286,45 @@ def insert_new_fxffile(db, newfile):
              fxf_id, version, database.revtype('new'), fxf_url)
     fxf_revision_id = db.cursor.lastrowid
 
-    # fetch and insert .fxf contents
-    fxf_handle = fetchurl(fxf_url)
-    fxf_handle.encoding = 'windows-1252'
-    fxf_text = fxf_handle.text
+    # fetch and insert .fxf contents, and parse new fixlets
+    fxf_text, fixlets = fetch_and_parse_fxf(fxf_url)
     db.query('INSERT INTO FxfContents VALUES (?,?)', fxf_revision_id, fxf_text)
 
-    # parse new fixlets
-    fixlets = fixlet_parser.parse_fxffile(fxf_text)
-
-    for fixlet_id in fixlets:
-        fixlet = fixlets[fixlet_id]
-
+    for fixlet in fixlets:
         # insert the new fixlet into the database
         # TODO this is a source of a bug! we indicate that this fixlet is new
         # but in fact it could already be present in the db in some other file
         # this bug may be in different places too so we should determine how
         # to make sure the db is correct after running update
-        db.query('INSERT INTO Revisions VALUES (?,?,?,?,?,?,?)',
-                 site_id, fixlet_id, version, database.revtype('new'),
-                 fixlet.modified, fixlet.title, fxf_revision_id)
-        fixlet_revision_id = db.cursor.lastrowid
-        db.query('INSERT INTO RevisionContents VALUES (?,?)',
-                 fixlet_revision_id, fixlet.contents)
+        insert_revision(db, site_id, fixlet, version, database.revtype('new'), fxf_revision_id)
 
     return True
 
-def update_fxffile(db, fxf_data, to_version):
+def current_fxffile(db, fxf_data):
     '''
-    Given a tuple as returned by fxffile_list, updates some .fxf file
-    to the latest version.
+    Given a tuple as returned by fxffile_list, returns the
+    (source url, text) of the latest contents of the .fxf file on disk.
     '''
     fxffile_id, site_id, latest, disk_latest, fxf_name = fxf_data
 
     # TODO could probably use fxffile_id here instead of matching by name
-    fxf_url, current_content = db.query('''
+    return db.query('''
 SELECT R.source_url, C.text
 FROM FxfRevisions R, FxfContents C, FxfFiles F
 WHERE C.revision=R.rowid AND R.fxf=F.rowid
   AND R.version=? AND F.name=? AND F.site=?''',
-                                        disk_latest, fxf_name, site_id)
+                    disk_latest, fxf_name, site_id)
+
+def update_fxffile(db, fxf_data, to_version, fetch=fetch_fxf_text, parse=parse_fxf_text):
+    '''
+    Given a tuple as returned by fxffile_list, updates some .fxf file
+    to the given version, using 'fetch' to get the text of each version
+    of the file (see fetch_fxf_text) and 'parse' to parse it (see
+    parse_fxf_text).
+    '''
+    fxffile_id, site_id, latest, disk_latest, fxf_name = fxf_data
+
+    fxf_url, current_content = current_fxffile(db, fxf_data)
     current_version = int(latest)
 
     while current_version < to_version:
@@ -553,7 +1333,7 @@ WHERE C.revision=R.rowid AND R.fxf=F.rowid
         fxf_url = add_version(strip_version(fxf_url), current_version)
 
         try:
-            fxf_handle = fetchurl(fxf_url)
+            fxf_text = fetch(fxf_url)
         except MissingUrlException:
             # we couldn't find it so it's probably missing
             db.query('UPDATE FxfFiles SET latest=? WHERE rowid=?',
@@ -563,9 +1343,6 @@ WHERE C.revision=R.rowid AND R.fxf=F.rowid
                      database.revtype('missing'), fxf_url)
             continue
 
-        fxf_handle.encoding = 'windows-1252'
-        fxf_text = fxf_handle.text
-
         if fxf_text == current_content: # TODO sometimes a problem with unicode casting here
             # file didn't change - bump up the version
             db.query('UPDATE FxfFiles SET latest=? WHERE rowid=?',
@@ -582,28 +1359,22 @@ WHERE C.revision=R.rowid AND R.fxf=F.rowid
                      fxf_revision_id, fxf_text)
 
             # parse and check if each fixlet changed
-            fixlets = fixlet_parser.parse_fxffile(fxf_text)
+            fixlets = parse(fxf_text)
 
-            for fixlet_id in fixlets:
-                fixlet = fixlets[fixlet_id]
-
-                last_fixlet = db.query('SELECT rowid, published, title FROM Revisions WHERE site=? AND fixlet_id=? ORDER BY version desc LIMIT 1',
+            for fixlet in fixlets:
+                fixlet_id = fixlet.fid
+                last_fixlet = db.query('SELECT rowid, published, title, valid_to FROM Revisions WHERE site=? AND fixlet_id=? ORDER BY version desc LIMIT 1',
                                        site_id, fixlet_id)
 
-                if last_fixlet == None:
-                    # new fixlet was added
+                if last_fixlet == None or last_fixlet[3] != database.VALID_FOREVER:
+                    # new fixlet was added (or one which was removed is back)
                     # TODO could also be a source of bug where fixlet marked new
                     # more than once - see above
-                    db.query('INSERT INTO Revisions VALUES (?,?,?,?,?,?,?)',
-                             site_id, fixlet_id, current_version,
-                             database.revtype('new'), fixlet.modified,
-                             fixlet.title, fxf_revision_id)
-                    fixlet_revision_id = db.cursor.lastrowid
-                    db.query('INSERT INTO RevisionContents VALUES (?,?)',
-                             fixlet_revision_id, fixlet.contents)
+                    insert_revision(db, site_id, fixlet, current_version,
+                                    database.revtype('new'), fxf_revision_id)
                     continue
 
-                last_fixlet_rowid, last_fixlet_modified, last_fixlet_title = last_fixlet
+                last_fixlet_rowid, last_fixlet_modified, last_fixlet_title, last_valid_to = last_fixlet
                 last_fixlet_contents = db.query('SELECT contents FROM RevisionContents WHERE id=?',
                                                 last_fixlet_rowid)[0]
 
@@ -613,22 +1384,50 @@ WHERE C.revision=R.rowid AND R.fxf=F.rowid
                     # fixlet did not change - ignore
                     continue
 
-                # record new update
-                db.query('INSERT INTO Revisions VALUES (?,?,?,?,?,?,?)',
-                         site_id, fixlet_id,
-                         current_version, database.revtype('changed'),
-                         fixlet.modified, fixlet.title,
-                         fxf_revision_id)
-                fixlet_revision_id = db.cursor.lastrowid
-                db.query('INSERT INTO RevisionContents VALUES (?,?)',
-                         fixlet_revision_id, fixlet.contents)
+                # record new update, which ends the validity of the last one
+                insert_revision(db, site_id, fixlet, current_version,
+                                database.revtype('changed'), fxf_revision_id)
+
+            close_removed_fixlets(db, site_id, fxffile_id, current_version,
+                                  set(fixlet.fid for fixlet in fixlets))
+
+def close_removed_fixlets(db, site_id, fxffile_id, version, present):
+    '''
+    Ends at 'version' the validity of the latest revision of every fixlet
+    which came from some fixlet file but is not among the fixlet ids
+    'present' in the file's new version, so that snapshots from that version
+    on leave it out. No revision is recorded for the removal; a fixlet which
+    comes back gets a new revision (see update_fxffile).
+
+    N.B. a fixlet moved to another file in the same version ends up removed
+    if that file is updated first, as its revision still came from this one.
+    '''
+    rows = db.connection.execute('''
+SELECT R.rowid, R.fixlet_id FROM Revisions R, FxfRevisions F
+WHERE R.site=? AND R.valid_to>? AND R.source_file=F.rowid AND F.fxf=?''',
+                                 (site_id, version, fxffile_id)).fetchall()
+    removed = [(version, revision_id) for revision_id, fixlet_id in rows
+               if not fixlet_id in present]
+    db.query_many('UPDATE Revisions SET valid_to=? WHERE rowid=?', removed)
             
 ### main functions directly called by update.py and seed.py
 
-@profile
 def seed():
     from datetime import datetime; now = datetime.now
     print 'start seed', str(now())
+    start_pools()
+    avoided = MISSING_AVOIDED.get()
+    metrics.start()
+    try:
+        with RUN_SECONDS.time(command='seed'):
+            _seed()
+    finally:
+        save_missing()
+        metrics.stop()
+    print '{} requests for missing files avoided'.format(MISSING_AVOIDED.get() - avoided)
+    print 'done', str(now())
+
+def _seed():
     urls = get_gather_urls_list()
     short_names = to_short_names(urls)
     site_contents = fetch_url_contents(urls)
@@ -645,10 +1444,12 @@ def seed():
 
     create_application_seed(short_names, urls, site_roots, metadata)
 
-@profile
-def update():
-    from datetime import datetime; now = datetime.now
-    print 'start update', str(now())
+def fetch_site_listings():
+    '''
+    Fetches the gather listing of every site in GATHER_SITES. Returns a tuple
+    (short names of the sites, dictionary from short name to site metadata,
+    list of site directories as returned by to_site_directories).
+    '''
     urls = get_gather_urls_list()
     short_names = to_short_names(urls)
     site_contents = fetch_url_contents(urls)
@@ -662,16 +1463,73 @@ def update():
         if site[0] is None:
             continue
         md[site[0]] = site[1]
-    metadata = md
 
+    return short_names, md, to_site_directories(site_contents)
+
+def update(order=UPDATE_ORDER):
+    from datetime import datetime; now = datetime.now
+    print 'start update', str(now())
+    start_pools()
+    avoided = MISSING_AVOIDED.get()
+    metrics.start()
+    try:
+        with RUN_SECONDS.time(command='update'):
+            _update(order)
+    finally:
+        save_missing()
+        metrics.stop()
+    print '{} requests for missing files avoided'.format(MISSING_AVOIDED.get() - avoided)
+    print 'done', str(now())
+
+def _update(order):
+    short_names, metadata, new_directories = fetch_site_listings()
+
+    database.init()
     old_directories = disk_site_directories()
-    new_directories = to_site_directories(site_contents)
     sites_added_fxffiles = find_added_fxffiles(short_names,
                                                old_directories, new_directories)
 
-    update_application_database(metadata, sites_added_fxffiles)
-    print 'done', str(now())
+    update_application_database(metadata, sites_added_fxffiles,
+                                dict(zip(short_names, new_directories)), order)
+
+def plan(order=UPDATE_ORDER, show_files=False):
+    '''
+    Prints how much work an update would do, without fetching any fixlet
+    file (see plan_site_update). Returns the site plans.
+    '''
+    short_names, metadata, directories = fetch_site_listings()
+    database.init()
+    outdated = outdated_sites(metadata)
+    plans = plan_update(outdated, metadata, dict(zip(short_names, directories)))
+    print_update_plan(plans, order, show_files)
+    return plans
+
+# globally used for multiprocessing (for parsing fixlet files), see start_pools()
+parse_pool = None
+
+# database file (None for the catalog) -> lock serializing writes to it, see
+# write_lock()
+write_locks = {}
 
-# globally used for multiprocessing (for distributing find_first_fxf)
-# initialized down here because of some possible bugs re: multiprocessing
-pool = multiprocessing.pool.ThreadPool(processes=PROCESS_POOL_SIZE)
+# globally used for multiprocessing (for distributing find_first_fxf and
+# fetching files), see start_pools()
+pool = None
+
+def start_pools():
+    '''
+    Start the parse pool and the thread pool, with PARSE_POOL_SIZE and
+    PROCESS_POOL_SIZE as they are set now, unless they are already started.
+    '''
+    global parse_pool, pool
+    if pool is not None:
+        return
+    # the parse pool is created before the thread pool so that no threads are
+    # running when it forks
+    if PARSE_POOL_SIZE > 0:
+        parse_pool = multiprocessing.Pool(processes=PARSE_POOL_SIZE)
+    pool = multiprocessing.pool.ThreadPool(processes=PROCESS_POOL_SIZE)
+
+# limits the requests in flight across every thread, see fetchurl()
+fetch_limit = throttle.AIMDLimit(FETCH_MIN_CONCURRENCY, FETCH_MAX_CONCURRENCY,
+                                 FETCH_INITIAL_CONCURRENCY, FETCH_SLOW_SECONDS,
+                                 name='fetch', log_interval=FETCH_LOG_INTERVAL)
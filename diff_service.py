@@ -1,24 +1,92 @@
 #!/usr/bin/python
 
+'''
+Computes differentials between two fixlet revisions (rows of
+RevisionContents) and prints them as JSON.
+
+Usage:
+python diff_service.py <old revision id> <new revision id>
+    Diff the two revisions and print the result.
+python diff_service.py --serve
+    Run as a long-lived worker. Each line read from stdin is a JSON request
+    {"id": ..., "old": <old revision id>, "new": <new revision id>} and is
+    answered by one line on stdout, either {"id": ..., "result": <diff>} or
+    {"id": ..., "error": <message>}. Database connections are kept open
+    between requests.
+python diff_service.py --history <site id> <fixlet id>
+    Diff each revision of a fixlet against the one before it, printing one
+    line {"old": {"id": ..., "version": ...}, "new": {...}, "result": <diff>}
+    per pair, oldest first.
+
+A differential is printed as [old file, new file, info], where info is
+{"degraded": true} if some strings were diffed with a cheaper strategy to
+stay within the diffing budget (see Budget).
+
+Differentials are cached in the table DiffCache, keyed by the two revision
+ids and DIFF_ALGORITHM_VERSION. In a sharded database, the revisions of a site
+are read from the site's own file (see SiteConnections).
+'''
+
 import difflib
 import Levenshtein as levenshtein
 import json
 import sqlite3
 import sys
 import re
+import time
 
-assert len(sys.argv) == 3
+import database
 
 ALL_KEYS = ['relevance', 'text', 'actions']
 DBNAME = 'fxfdata.db'
 
-connection = sqlite3.connect(DBNAME)
-old_id = sys.argv[1]
-new_id = sys.argv[2]
-statement = 'Select contents From RevisionContents Where id=?'
+'''
+Version of the diffing algorithm. Bump this whenever the output of
+diff_contents changes so that stale cached differentials are not served.
+'''
+DIFF_ALGORITHM_VERSION = 4
+
+'''
+Whether to diff multi-line strings line by line first, running the
+character-level diff only on the blocks of lines which changed.
+'''
+HIERARCHICAL_DIFF = True
+
+'''
+The line separator of preprocessed strings (see preprocess_input).
+'''
+LINE_BREAK = '<br />'
+
+'''
+Wall-clock time in seconds allowed for computing one differential. Once it
+is spent, the remaining strings are diffed with block_replace.
+'''
+DIFF_TIME_BUDGET = 2.0
+
+'''
+Largest combined length of two strings (or blocks of lines) that is diffed
+character by character. Larger blocks are matched line by line only.
+'''
+MAX_CHARACTER_DIFF_SIZE = 20000
+
+'''
+Largest combined number of lines of two strings that is matched line by line.
+Larger strings are diffed with block_replace.
+'''
+MAX_LINE_DIFF_SIZE = 20000
+
+'''
+Maximum total size in bytes of the cached differentials. When it is exceeded,
+the least recently used differentials are evicted.
+'''
+DIFF_CACHE_SIZE = 256 * 2**20
 
-s1 = json.loads(connection.execute(statement, (old_id,)).fetchone()[0])
-s2 = json.loads(connection.execute(statement, (new_id,)).fetchone()[0])
+'''
+Number of cache hits whose use is recorded (for the order of eviction)
+together, in one write which is skipped if the database is locked, so that a
+hit never waits for the write lock (e.g. held by an update).
+'''
+DIFF_CACHE_TOUCH_BATCH = 50
 
 diff_formats = {
     'equal': lambda x, y: (x, y),
@@ -29,20 +97,140 @@ diff_formats = {
 }
 
 def transform_output(old_string, new_string, opcodes):
-    old_out, new_out = u'', u''
+    old_out, new_out = [], []
     for opcode in opcodes:
         transform_func = diff_formats[opcode[0]]
         old_substr = old_string[opcode[1]:opcode[2]]
         new_substr = new_string[opcode[3]:opcode[4]]
         output = transform_func(old_substr, new_substr)
-        old_out += output[0]
-        new_out += output[1]
-    return old_out, new_out
+        old_out.append(output[0])
+        new_out.append(output[1])
+    return u''.join(old_out), u''.join(new_out)
 
 def preprocess_input(old_string):
     return re.sub('&lt;!--.*?--&gt;', '', old_string.replace('\n', '<br />'))
 
-def diff(old_string, new_string):
+def split_lines(string):
+    '''
+    Split a preprocessed string into lines, keeping the line breaks so that
+    the lines join back into the original string.
+    '''
+    lines = string.split(LINE_BREAK)
+    return [line + LINE_BREAK for line in lines[:-1]] + [lines[-1]]
+
+class Budget:
+    '''
+    The time and size limits for computing one differential. Records whether
+    any string had to be diffed with a cheaper strategy, and whether that was
+    because time ran out (as opposed to the input being too large).
+    '''
+    def __init__(self, seconds=DIFF_TIME_BUDGET):
+        self.deadline = time.time() + seconds
+        self.degraded = False
+        self.timed_out = False
+    def allows(self, size, limit):
+        '''
+        Returns whether some work of the given size (with the given limit) is
+        within the budget, marking the budget as degraded if it is not.
+        '''
+        if time.time() > self.deadline:
+            self.timed_out = True
+        elif size <= limit:
+            return True
+        self.degraded = True
+        return False
+
+def block_replace(old_string, new_string):
+    '''
+    Compute a diff in 'opcode format' in linear time: the common prefix and
+    suffix of the strings are kept and everything between them is replaced.
+    '''
+    limit = min(len(old_string), len(new_string))
+    prefix = 0
+    while prefix < limit and old_string[prefix] == new_string[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix and
+           old_string[-suffix-1] == new_string[-suffix-1]):
+        suffix += 1
+
+    old_end, new_end = len(old_string) - suffix, len(new_string) - suffix
+    opcodes = []
+    if prefix > 0:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+    if old_end > prefix and new_end > prefix:
+        opcodes.append(('replace', prefix, old_end, prefix, new_end))
+    elif old_end > prefix:
+        opcodes.append(('delete', prefix, old_end, prefix, prefix))
+    elif new_end > prefix:
+        opcodes.append(('insert', prefix, prefix, prefix, new_end))
+    if suffix > 0:
+        opcodes.append(('equal', old_end, len(old_string), new_end, len(new_string)))
+    return opcodes
+
+def diff(old_string, new_string, budget=None):
+    '''
+    Compute the diff in 'opcode format' between the old and new string,
+    hierarchically if HIERARCHICAL_DIFF is set (see hierarchical_diff).
+
+    Strings too large for the budget (a fresh Budget if none is given) are
+    diffed hierarchically anyway, or with block_replace.
+    '''
+    if budget is None:
+        budget = Budget()
+    if (not HIERARCHICAL_DIFF and
+        budget.allows(len(old_string) + len(new_string), MAX_CHARACTER_DIFF_SIZE)):
+        return character_diff(old_string, new_string)
+    return hierarchical_diff(old_string, new_string, budget)
+
+def hierarchical_diff(old_string, new_string, budget):
+    '''
+    Compute the diff in 'opcode format' between the old and new string by
+    first matching their lines, then running character_diff on each block of
+    replaced lines only.
+
+    Character-level diffing is quadratic in the worst case, so this keeps
+    large, mostly unchanged strings (e.g. action scripts and descriptions)
+    cheap to diff. Blocks which do not fit in the budget are diffed with
+    block_replace instead.
+    '''
+    old_lines = split_lines(old_string)
+    new_lines = split_lines(new_string)
+    if len(old_lines) == 1 and len(new_lines) == 1:
+        return budget_diff(old_string, new_string, budget)
+    if not budget.allows(len(old_lines) + len(new_lines), MAX_LINE_DIFF_SIZE):
+        return block_replace(old_string, new_string)
+
+    # character offsets of the start of each line
+    old_offsets = [0]
+    for line in old_lines:
+        old_offsets.append(old_offsets[-1] + len(line))
+    new_offsets = [0]
+    for line in new_lines:
+        new_offsets.append(new_offsets[-1] + len(line))
+
+    opcodes = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        a1, a2 = old_offsets[i1], old_offsets[i2]
+        b1, b2 = new_offsets[j1], new_offsets[j2]
+        if tag != 'replace':
+            opcodes.append((tag, a1, a2, b1, b2))
+            continue
+        for code in budget_diff(old_string[a1:a2], new_string[b1:b2], budget):
+            opcodes.append((code[0], code[1]+a1, code[2]+a1, code[3]+b1, code[4]+b1))
+    return opcodes
+
+def budget_diff(old_string, new_string, budget):
+    '''
+    Compute the diff with character_diff if it is within the budget,
+    otherwise with block_replace.
+    '''
+    if budget.allows(len(old_string) + len(new_string), MAX_CHARACTER_DIFF_SIZE):
+        return character_diff(old_string, new_string)
+    return block_replace(old_string, new_string)
+
+def character_diff(old_string, new_string):
     '''
     Compute the diff in 'opcode format' between the old and new string.
 
@@ -60,34 +248,339 @@ def diff(old_string, new_string):
     usually yield the contiguous diffs given by LCS except when it produces
     very suboptimal diffs, in which case we use Levenshtein edits instead.
     '''
-    difflib_codes = difflib.SequenceMatcher(None, before, after).get_opcodes()
-    levenshtein_codes = levenshtein.opcodes(before, after)
+    difflib_codes = difflib.SequenceMatcher(None, old_string, new_string).get_opcodes()
+    levenshtein_codes = levenshtein.opcodes(old_string, new_string)
     return min(difflib_codes, levenshtein_codes, key=lambda x: len(x))
-    
-
-old_file = {}
-new_file = {}
-for key in ALL_KEYS:
-    # if key == 'text': # TODO remove after conversion on db-side?
-    #     s1[key] = [s1[key]]
-    #     s2[key] = [s2[key]]
-
-    m = max(len(s1[key]), len(s2[key]))
-    s1[key] += [u''] * (m-len(s1[key]))
-    s2[key] += [u''] * (m-len(s2[key]))
-
-    if len(s1[key]) != 0:
-        old_file[key] = []
-        new_file[key] = []
-    for i in range(len(s1[key])):
-        before, after = map(preprocess_input, (s1[key][i], s2[key][i]))
-        opcodes = diff(before, after)
-        o1, o2 = transform_output(before, after, opcodes)
-        old_file[key].append(o1)
-        new_file[key].append(o2)
-
-print json.dumps([old_file, new_file])
-
-#print 'TODO: future diff goes here'
-#print 'was passed in parameters {} and {}'.format(sys.argv[1], sys.argv[2])
 
+def load_contents(connection, revision_id):
+    '''
+    Returns the decoded contents of a fixlet revision (a row of
+    RevisionContents).
+    '''
+    statement = 'Select contents From RevisionContents Where id=?'
+    row = connection.execute(statement, (revision_id,)).fetchone()
+    if row is None:
+        raise KeyError('no revision with id {}'.format(revision_id))
+    return json.loads(row[0])
+
+def diff_contents(s1, s2, budget=None):
+    '''
+    Given the decoded contents of an old and a new fixlet revision, returns
+    their differential as a list [old file, new file, info]. The files are
+    dictionaries from each key in ALL_KEYS to a list of marked-up strings, and
+    info is a dictionary telling whether the differential was degraded to
+    stay within the budget (a fresh Budget if none is given).
+    '''
+    return diff_prepared(prepare_contents(s1), prepare_contents(s2), budget)
+
+def prepare_contents(contents):
+    '''
+    Given the decoded contents of a fixlet revision, returns a dictionary from
+    each key in ALL_KEYS to the list of its preprocessed elements.
+    '''
+    return dict((key, [preprocess_input(element or u'') for element in contents[key]])
+                for key in ALL_KEYS)
+
+def diff_prepared(old_prepared, new_prepared, budget=None):
+    '''
+    Same as diff_contents, but given the contents of both revisions as
+    returned by prepare_contents.
+    '''
+    if budget is None:
+        budget = Budget()
+    old_file = {}
+    new_file = {}
+    for key in ALL_KEYS:
+        old_elements = old_prepared[key]
+        new_elements = new_prepared[key]
+        if len(old_elements) == 0 and len(new_elements) == 0:
+            continue
+        old_file[key], new_file[key] = diff_elements(old_elements, new_elements, budget)
+
+    return [old_file, new_file, {'degraded': budget.degraded}]
+
+def diff_elements(old_elements, new_elements, budget):
+    '''
+    Given the old and new lists of preprocessed elements (e.g. relevance
+    clauses or actions) of a fixlet, returns two equally long lists of
+    marked-up strings, where the strings at each index are the two sides of
+    one differential.
+
+    The lists are first aligned by matching identical elements (by hash, with
+    the longest common subsequence), so that an element inserted or removed
+    in the middle does not pair every element after it with the wrong
+    partner. Identical elements are not diffed at all; only elements in
+    replaced blocks are diffed, pairwise in order.
+    '''
+    old_out, new_out = [], []
+    matcher = difflib.SequenceMatcher(None, old_elements, new_elements, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            old_out += old_elements[i1:i2]
+            new_out += new_elements[j1:j2]
+            continue
+
+        # pad the shorter side so that the extra elements show as added or removed
+        m = max(i2-i1, j2-j1)
+        befores = old_elements[i1:i2] + [u''] * (m-(i2-i1))
+        afters = new_elements[j1:j2] + [u''] * (m-(j2-j1))
+        for before, after in zip(befores, afters):
+            opcodes = diff(before, after, budget)
+            o1, o2 = transform_output(before, after, opcodes)
+            old_out.append(o1)
+            new_out.append(o2)
+    return old_out, new_out
+
+class DiffCache:
+    '''
+    A size-bounded cache of rendered differentials stored in the DiffCache
+    table. Failures to read or write the table (e.g. while the database is
+    locked by an update) are treated as cache misses.
+    '''
+    def __init__(self, connection, max_size=DIFF_CACHE_SIZE):
+        self.connection = connection
+        self.max_size = max_size
+        self.size = None # total size of the cache, loaded lazily
+        self.touched = {} # rowid -> last use of the hits not recorded yet
+    def has(self, old_id, new_id):
+        '''Returns whether the differential of two revisions is cached.'''
+        return self._find(old_id, new_id, 'rowid') is not None
+    def get(self, old_id, new_id):
+        '''Returns the cached differential of two revisions, or None.'''
+        row = self._find(old_id, new_id, 'rowid, contents')
+        if row is None:
+            return None
+        self.touched[row[0]] = time.time()
+        if len(self.touched) >= DIFF_CACHE_TOUCH_BATCH:
+            self._touch()
+        return json.loads(row[1])
+    def put(self, old_id, new_id, differential):
+        '''Caches the differential of two revisions.'''
+        contents = json.dumps(differential)
+        try:
+            with self.connection:
+                self.connection.execute('Insert Or Replace Into DiffCache Values (?,?,?,?,?,?)',
+                                        (old_id, new_id, DIFF_ALGORITHM_VERSION,
+                                         contents, len(contents), time.time()))
+                self._update_last_used()
+                if self.size is None:
+                    self.size = self._total_size()
+                else:
+                    self.size += len(contents)
+                if self.size > self.max_size:
+                    self._evict()
+            self.touched = {}
+        except sqlite3.Error:
+            self.size = None
+    def _find(self, old_id, new_id, columns):
+        try:
+            return self.connection.execute(
+                'Select {} From DiffCache Where old=? And new=? And algorithm=?'.format(columns),
+                (old_id, new_id, DIFF_ALGORITHM_VERSION)).fetchone()
+        except sqlite3.Error:
+            return None
+    def _update_last_used(self):
+        self.connection.executemany('Update DiffCache Set last_used=? Where rowid=?',
+                                    [(used, rowid) for rowid, used in self.touched.iteritems()])
+    def flush(self):
+        '''Records the use of the hits which are not recorded yet, if it can.'''
+        if len(self.touched) > 0:
+            self._touch()
+    def _touch(self):
+        # record the hits without waiting for the write lock: if the database
+        # is locked they are kept for the next try, as they only affect the
+        # order of eviction
+        timeout = self.connection.execute('Pragma busy_timeout').fetchone()[0]
+        self.connection.execute('Pragma busy_timeout=0')
+        try:
+            with self.connection:
+                self._update_last_used()
+            self.touched = {}
+        except sqlite3.Error:
+            pass
+        finally:
+            self.connection.execute('Pragma busy_timeout={}'.format(timeout))
+    def _total_size(self):
+        return self.connection.execute('Select coalesce(sum(size), 0) From DiffCache').fetchone()[0]
+    def _evict(self):
+        # other processes share the table, so recount before evicting, and
+        # evict down to 90% of the maximum so that this does not run on every put
+        self.size = self._total_size()
+        excess = self.size - int(self.max_size * 0.9)
+        if excess <= 0:
+            return
+        evicted = []
+        for rowid, size in self.connection.execute('Select rowid, size From DiffCache Order By last_used'):
+            if excess <= 0:
+                break
+            evicted.append((rowid,))
+            excess -= size
+            self.size -= size
+        self.connection.executemany('Delete From DiffCache Where rowid=?', evicted)
+
+class SiteConnections:
+    '''
+    Connections to a database, and a DiffCache for each, opened when first
+    needed and kept open: one per site in a sharded database (see
+    database.connect), otherwise one for every site.
+    '''
+    def __init__(self, dbname=DBNAME):
+        self.dbname = dbname
+        self.sharded = database.sharded(dbname)
+        self.sites = set() # sites which have a shard, loaded lazily
+        self.connections = {} # site (None if not sharded) -> (connection, DiffCache)
+    def site(self, site_id):
+        '''Returns the connection and DiffCache for reading a site.'''
+        key = site_id if self.sharded else None
+        if not key in self.connections:
+            if self.sharded and not site_id in self.sites:
+                # sites may have been seeded since
+                self.sites = set(database.shards(self.dbname))
+                if not site_id in self.sites:
+                    raise KeyError('no site ' + str(site_id))
+            connection = database.connect(self.dbname, key, create=False)
+            self.connections[key] = (connection, DiffCache(connection))
+        return self.connections[key]
+    def revision(self, revision_id):
+        '''Returns the connection and DiffCache for reading a revision.'''
+        return self.site(database.rowid_site(revision_id))
+    def close(self):
+        for connection, cache in self.connections.itervalues():
+            cache.flush()
+            connection.close()
+        self.connections = {}
+
+def diff_revisions(connection, old_id, new_id, cache=None):
+    '''
+    Returns the differential (see diff_contents) of two fixlet revisions,
+    using and filling the given DiffCache if there is one.
+    '''
+    if cache is not None:
+        differential = cache.get(old_id, new_id)
+        if differential is not None:
+            return differential
+
+    budget = Budget()
+    differential = diff_contents(load_contents(connection, old_id),
+                                 load_contents(connection, new_id), budget)
+    # a differential degraded by running out of time depends on the load of
+    # the machine, so it is not kept
+    if cache is not None and not budget.timed_out:
+        cache.put(old_id, new_id, differential)
+    return differential
+
+def diff_history(connection, site_id, fixlet_id, cache=None):
+    '''
+    Generates the differential of each revision of a fixlet against the
+    revision before it, oldest first, as dictionaries
+    {'old': {'id': ..., 'version': ...}, 'new': {...}, 'result': differential}.
+
+    All revisions are read with one ordered query, and each is decoded and
+    preprocessed at most once even though it takes part in two pairs. Cached
+    differentials are used and filled when a DiffCache is given.
+    '''
+    rows = connection.execute('''
+Select R.rowid, R.version, C.contents
+From Revisions R, RevisionContents C
+Where C.id=R.rowid And R.site=? And R.fixlet_id=?
+Order By R.version''', (site_id, fixlet_id)).fetchall() # cache writes would reset the cursor
+
+    previous = None # (id, version, contents, prepared contents or None)
+    for revision_id, version, contents in rows:
+        current = [revision_id, version, contents, None]
+        if previous is not None:
+            differential = None if cache is None else cache.get(previous[0], revision_id)
+            if differential is None:
+                for revision in (previous, current):
+                    if revision[3] is None:
+                        revision[3] = prepare_contents(json.loads(revision[2]))
+                budget = Budget()
+                differential = diff_prepared(previous[3], current[3], budget)
+                if cache is not None and not budget.timed_out:
+                    cache.put(previous[0], revision_id, differential)
+            yield {'old': {'id': previous[0], 'version': previous[1]},
+                   'new': {'id': revision_id, 'version': version},
+                   'result': differential}
+        previous = current
+
+def precompute(dbname=DBNAME, first_revisions=None):
+    '''
+    Diff every revision added since 'first_revisions' against the previous
+    revision of the same fixlet and cache the results, so that the most
+    commonly viewed differentials are served from the cache. A sharded
+    database is read one site at a time.
+
+    'first_revisions' is a dictionary from the first rowid of the range of
+    each shard (see database.id_range) to the first new rowid in that range,
+    as returned by database.next_rowids before the revisions were added.
+    Shards missing from it are diffed entirely, as is every shard if it is
+    None.
+
+    Returns the number of differentials computed.
+    '''
+    computed = 0
+    for site in database.shards(dbname):
+        start, end = database.id_range(site)
+        first = start if first_revisions is None else first_revisions.get(start, start)
+        connection = database.connect(dbname, site)
+        try:
+            pairs = connection.execute('''
+Select (Select P.rowid From Revisions P
+        Where P.site=N.site And P.fixlet_id=N.fixlet_id And P.version<N.version
+        Order By P.version Desc Limit 1), N.rowid
+From Revisions N Where N.rowid>=? And N.rowid<?''', (first, end)).fetchall()
+
+            cache = DiffCache(connection)
+            for old_id, new_id in pairs:
+                if old_id is None or cache.has(old_id, new_id):
+                    continue
+                # caches the differential unless it was degraded by running out of time
+                diff_revisions(connection, old_id, new_id, cache)
+                computed += 1
+        finally:
+            connection.close()
+    return computed
+
+def serve(connections, requests=sys.stdin, responses=sys.stdout):
+    '''
+    Answer line-delimited JSON diff requests until 'requests' is closed,
+    reading each pair of revisions through SiteConnections.
+    See the usage at the top of this file.
+    '''
+    # readline instead of iteration: iterating a pipe reads ahead and
+    # would hold back requests
+    for line in iter(requests.readline, ''):
+        if line.strip() == '':
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            old_id, new_id = int(request['old']), int(request['new'])
+            connection, cache = connections.revision(new_id)
+            response = {'id': request_id,
+                        'result': diff_revisions(connection, old_id, new_id, cache)}
+        except Exception as e:
+            response = {'id': request_id, 'error': '{}: {}'.format(type(e).__name__, e)}
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()
+
+def main(argv):
+    connections = SiteConnections(DBNAME)
+    try:
+        if argv == ['--serve']:
+            serve(connections)
+        elif len(argv) == 3 and argv[0] == '--history':
+            connection, cache = connections.site(int(argv[1]))
+            for pair in diff_history(connection, int(argv[1]), int(argv[2]), cache):
+                print json.dumps(pair)
+                sys.stdout.flush()
+        else:
+            assert len(argv) == 2
+            connection, cache = connections.revision(int(argv[1]))
+            print json.dumps(diff_revisions(connection, int(argv[0]), int(argv[1]), cache))
+    finally:
+        connections.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+'''
+Exports fixlets from the application database: a snapshot of a site (every
+fixlet of the site as it was at some version) or one fixlet at some version,
+either as JSON lines or as a gzipped tarball of one JSON file per fixlet.
+
+Revisions are found through their validity intervals (see
+database.VALID_FOREVER) with a single range scan, and each one is written as
+soon as it is read, so that a snapshot of any size is exported without being
+loaded into memory. A fixlet removed from its fixlet file is left out of the
+snapshots from the version it was removed in (see
+dataminer.close_removed_fixlets). The database is only read: a missing
+database or shard is an error rather than being created.
+
+e.g.
+python export.py bessecurity --version 2045 --format tar --output bessecurity-2045.tar.gz
+python export.py bessecurity --fixlet 1234 --version 2045
+'''
+
+import argparse
+import json
+import sys
+import tarfile
+import time
+from cStringIO import StringIO
+
+import database
+
+def revisions(connection, site_id, version=None, fixlet_id=None):
+    '''
+    Yields the revision of every fixlet of a site (or only of 'fixlet_id')
+    which was valid at some version, the latest if 'version' is None, as
+    dictionaries.
+    '''
+    if version is None:
+        version = database.VALID_FOREVER - 1
+    sql = '''
+Select R.rowid, R.fixlet_id, R.version, R.type, R.published, R.title, C.contents
+From Revisions R, RevisionContents C
+Where C.id=R.rowid And R.site=? And R.valid_to>? And R.valid_from<=?'''
+    args = (site_id, version, version)
+    if fixlet_id is not None:
+        sql += ' And R.fixlet_id=?'
+        args += (fixlet_id,)
+
+    for revision_id, fid, revision_version, revision_type, published, title, contents in \
+            connection.execute(sql, args):
+        yield {'id': revision_id, 'fixlet_id': fid, 'version': revision_version,
+               'type': database.revtype_name(revision_type),
+               'published': published, 'title': title, 'contents': json.loads(contents)}
+
+def write_jsonl(out, site_name, fixlets):
+    '''
+    Writes each fixlet as a line of JSON and returns how many were written.
+    '''
+    count = 0
+    for fixlet in fixlets:
+        fixlet['site'] = site_name
+        out.write(json.dumps(fixlet, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+def write_tar(out, prefix, site_name, fixlets):
+    '''
+    Writes a gzipped tarball with each fixlet as <prefix>/<fixlet id>.json
+    and returns how many were written.
+    '''
+    count = 0
+    # a stream ('w|gz') is written sequentially, without seeking back
+    archive = tarfile.open(fileobj=out, mode='w|gz')
+    try:
+        for fixlet in fixlets:
+            fixlet['site'] = site_name
+            data = json.dumps(fixlet, sort_keys=True, indent=2)
+            info = tarfile.TarInfo('{}/{}.json'.format(prefix, fixlet['fixlet_id']))
+            info.size = len(data)
+            info.mtime = time.time()
+            archive.addfile(info, StringIO(data))
+            count += 1
+    finally:
+        archive.close()
+    return count
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Export a site snapshot or a fixlet revision.')
+    parser.add_argument('site', help='name or id of the site')
+    parser.add_argument('--version', type=int,
+                        help='version of the site to export (default: the latest); fixlets '
+                             'removed from the site by then are left out')
+    parser.add_argument('--fixlet', type=int, help='export only the fixlet with this id')
+    parser.add_argument('--format', choices=('jsonl', 'tar'), default='jsonl')
+    parser.add_argument('--output', help='file to write to (default: stdout)')
+    parser.add_argument('--database', default=database.DBNAME)
+    options = parser.parse_args(argv)
+
+    site_id, site_name = database.find_site(options.database, options.site)
+    connection = database.connect(options.database, site_id, create=False)
+    out = open(options.output, 'wb') if options.output else sys.stdout
+    try:
+        fixlets = revisions(connection, site_id, options.version, options.fixlet)
+        if options.format == 'tar':
+            prefix = '{}_{}'.format(site_name, 'latest' if options.version is None else options.version)
+            count = write_tar(out, prefix, site_name, fixlets)
+        else:
+            count = write_jsonl(out, site_name, fixlets)
+    finally:
+        connection.close()
+        if options.output:
+            out.close()
+
+    if count == 0:
+        print >> sys.stderr, 'no fixlets found'
+        return 1
+    print >> sys.stderr, 'exported {} fixlets'.format(count)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+'''
+A local stand-in for sync.bigfix.com, serving synthetic sites (see
+synthetic_corpus.py) with generated version histories:
+
+/cgi-bin/bfgather/<site>              gather listing at the published version
+/bfsites/<site>_<version>/<name>.fxf  a fixlet file at some version
+/bfsites/<site>_<version>/__fullsite  a zip archive of a whole site version
+
+Files are added to a site over time and change at random versions. Versions
+can be made missing (every file of a missing version is a 404), files can be
+made broken (every request for them fails with a 503), and requests can be
+slowed down or made to fail at random with a 503, so that the fetch logic of
+dataminer.py can be exercised offline.
+
+e.g.
+python fake_sync.py --port 8000 --sites 2 --versions 50 --missing 7,8
+'''
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import collections
+import random
+import re
+import sys
+import threading
+import time
+import urllib
+import zipfile
+from cStringIO import StringIO
+
+import synthetic_corpus
+
+FXF_PATH = re.compile(r'^/bfsites/(.+)_(\d+)/([^/]+)$')
+GATHER_PATH = re.compile(r'^/cgi-bin/bfgather/([^/]+)$')
+
+class SyncSite:
+    '''
+    The version history of one synthetic site.
+
+    'files' fixlet files exist from version 1 and 'added_files' more are added
+    at random later versions. At every version after the one it was added in,
+    each file changes with probability 'change_rate'. Only versions up to
+    'published' are visible; publish() moves it forward. Every version of the
+    files named in 'broken' fails with a 503. For each (file name, version)
+    in 'removed', the file changes at that version and loses its last fixlet.
+    '''
+    def __init__(self, name, versions, published=None, files=5, added_files=0,
+                 fixlets=10, change_rate=0.1, action_size=200, missing=(), broken=(),
+                 removed=(), seed=0):
+        rng = random.Random('{}:{}'.format(name, seed))
+        self.name = name
+        self.versions = versions
+        self.published = versions if published is None else published
+        self.fixlets = fixlets
+        self.action_size = action_size
+        self.missing = set(missing)
+        self.broken = set(broken)
+        self.seed = seed
+        # file name -> (file index, versions at which its contents change)
+        self.history = {}
+        for i in range(files + added_files):
+            first = 1 if i < files or versions < 2 else rng.randint(2, versions)
+            changes = [first] + [v for v in range(first+1, versions+1)
+                                 if rng.random() < change_rate]
+            self.history['{:04d}'.format(i)] = (i, changes)
+        self.removed = list(removed)
+        for name, version in self.removed:
+            changes = self.history[name][1]
+            if not version in changes:
+                changes.append(version)
+                changes.sort()
+        self._contents = {} # (name, version of last change) -> text
+
+    def publish(self, version):
+        self.published = min(version, self.versions)
+
+    def exists(self, version):
+        return 1 <= version <= self.published and not version in self.missing
+
+    def files(self, version):
+        '''
+        Returns the names of the files which exist at some version.
+        '''
+        return sorted(name for name, (i, changes) in self.history.iteritems()
+                      if changes[0] <= version)
+
+    def contents(self, version, name):
+        '''
+        Returns the text of a file at some version, or None if it does not
+        exist at that version.
+        '''
+        if not self.exists(version):
+            return None
+        return self._text(version, name)
+
+    def _text(self, version, name):
+        if not name in self.history:
+            return None
+        i, changes = self.history[name]
+        changed = [v for v in changes if v <= version]
+        if len(changed) == 0:
+            return None
+        key = (name, changed[-1])
+        if not key in self._contents:
+            fixlets = self.fixlets - len([version for removed, version in self.removed
+                                          if removed == name and version <= changed[-1]])
+            self._contents[key] = synthetic_corpus.fxffile(
+                fixlets, 1, self.action_size, first_id=i*self.fixlets + 1,
+                seed=hash((self.name, self.seed, key)) & 0xffffffff)
+        return self._contents[key]
+
+    def listing(self, sync_url):
+        '''
+        Returns the gather listing at the published version.
+        '''
+        version = self.published
+        entries = [(name, self._text(version, name)) for name in self.files(version)]
+        return synthetic_corpus.gather_listing(self.name, version, entries, sync_url=sync_url)
+
+    def fullsite(self, version):
+        '''
+        Returns a zip archive of every file at some version, or None if the
+        version does not exist.
+        '''
+        if not self.exists(version):
+            return None
+        data = StringIO()
+        with zipfile.ZipFile(data, 'w') as archive:
+            for name in self.files(version):
+                archive.writestr(name + '.fxf', self._text(version, name))
+        return data.getvalue()
+
+class SyncHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if server.rng.random() < server.error_rate:
+            return self.reply('error', 503, 'injected error')
+
+        path = urllib.unquote(self.path)
+        match = GATHER_PATH.match(path)
+        if match and match.group(1) in server.sites:
+            return self.reply('gather', 200, server.sites[match.group(1)].listing(server.url))
+
+        match = FXF_PATH.match(path)
+        if match and match.group(1) in server.sites:
+            site, version, name = match.group(1), int(match.group(2)), match.group(3)
+            if name == '__fullsite':
+                return self.reply('fullsite', 200, server.sites[site].fullsite(version))
+            if name[:-4] in server.sites[site].broken:
+                return self.reply('error', 503, 'broken file')
+            if name.endswith('.fxf'):
+                return self.reply('fxf', 200, server.sites[site].contents(version, name[:-4]))
+        return self.reply('other', 404, None)
+
+    def reply(self, kind, status, body):
+        if body is None:
+            status, body = 404, 'not found'
+        self.server.count(kind, status, len(body))
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class SyncServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Serves a dictionary of SyncSite by name. Every request is delayed by
+    'latency' seconds and fails with probability 'error_rate'.
+
+    'requests' counts the requests served by (kind, status) and 'bytes' the
+    bytes of content sent.
+    '''
+    daemon_threads = True
+
+    def __init__(self, sites, port=0, latency=0, error_rate=0, seed=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), SyncHandler)
+        self.sites = dict((site.name, site) for site in sites)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.requests = collections.Counter()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def count(self, kind, status, size):
+        with self.lock:
+            self.requests[(kind, status)] += 1
+            self.bytes += size
+
+    def gather_urls(self):
+        return [synthetic_corpus.gather_url(name, self.url) for name in sorted(self.sites)]
+
+    def start(self):
+        '''
+        Serve in a background thread.
+        '''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+def add_arguments(parser):
+    '''
+    Add the options describing the simulated sites to an argparse parser.
+    '''
+    parser.add_argument('--sites', type=int, default=2, help='number of sites')
+    parser.add_argument('--versions', type=int, default=20, help='versions of each site')
+    parser.add_argument('--files', type=int, default=5, help='fxf files of each site at version 1')
+    parser.add_argument('--added-files', type=int, default=2,
+                        help='fxf files added to each site after version 1')
+    parser.add_argument('--fixlets', type=int, default=10, help='fixlets per fxf file')
+    parser.add_argument('--change-rate', type=float, default=0.1,
+                        help='probability of a file changing at each version')
+    parser.add_argument('--action-size', type=int, default=200,
+                        help='approximate characters of action script per fixlet')
+    parser.add_argument('--missing', default='',
+                        help='comma-separated versions which are missing from every site')
+    parser.add_argument('--broken', default='',
+                        help='comma-separated names of files (e.g. 0003) which always fail with a 503')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='probability of a request failing with a 503')
+    parser.add_argument('--seed', type=int, default=0)
+
+def create_server(options, port=0):
+    '''
+    Create a SyncServer from options parsed with add_arguments.
+    '''
+    missing = [int(v) for v in options.missing.split(',') if v.strip()]
+    broken = [name.strip() for name in options.broken.split(',') if name.strip()]
+    sites = [SyncSite('synthetic{}'.format(i), options.versions, files=options.files,
+                      added_files=options.added_files, fixlets=options.fixlets,
+                      change_rate=options.change_rate, action_size=options.action_size,
+                      missing=missing, broken=broken, seed=options.seed)
+             for i in range(options.sites)]
+    return SyncServer(sites, port, options.latency, options.error_rate, options.seed)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Serve synthetic sites in place of sync.bigfix.com.')
+    parser.add_argument('--port', type=int, default=8000)
+    add_arguments(parser)
+    options = parser.parse_args(argv)
+
+    server = create_server(options, options.port)
+    print 'serving at ' + server.url + ', gather urls:'
+    for url in server.gather_urls():
+        print url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -4,9 +4,14 @@
 A library of parsing functions for fixlets.
 '''
 
+import collections
 import json
 import cgi
 import re
+import tarfile
+import threading
+import urllib
+import zipfile
 
 '''
 The regular expression for matching the format of an attribute in a directory
@@ -35,6 +40,12 @@ Regular expression for a HTML omment.
 '''
 COMMENT_REGEX = '<!--.*?-->'
 
+'''
+A compact, picklable summary of a parsed fixlet, as produced by
+'parse_fxffile_rows(text)'. It shares its attribute names with Fixlet.
+'''
+FixletRow = collections.namedtuple('FixletRow', ('fid', 'title', 'modified', 'contents'))
+
 class FixletParsingException(Exception):
     pass
 
@@ -103,6 +114,61 @@ def parse_directory_metadata(text):
 
     return properties
 
+class FullSite:
+    '''
+    The fixlet files of a full site archive, read out of the archive one at a
+    time when asked for. Reads may come from several threads.
+    '''
+    def __init__(self, members, read_member):
+        self.members = members
+        self.read_member = read_member
+        self.lock = threading.Lock()
+
+    def read(self, name):
+        '''
+        Returns the raw contents of the fixlet file with some (unquoted) name,
+        without .fxf, or None if it is not in the archive.
+        '''
+        member = self.members.get(name)
+        if member is None:
+            return None
+        with self.lock:
+            return self.read_member(member)
+
+def parse_fullsite(archive):
+    '''
+    Open a full site archive (the file served at a site's FullSiteURL), given
+    as a seekable file, and return a FullSite for its fixlet files. Only the
+    list of members is read here.
+
+    The format of the archive is not documented: zip and tar archives are
+    recognized. For anything else, or an archive without any fixlet file,
+    this raises FixletParsingException so that callers can fall back to
+    fetching each file individually.
+    '''
+    def fxf_name(path):
+        return urllib.unquote(path[path.rfind('/')+1:-4])
+
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        z = zipfile.ZipFile(archive)
+        members = dict((fxf_name(info.filename), info) for info in z.infolist()
+                       if info.filename.endswith('.fxf'))
+        site = FullSite(members, z.read)
+    else:
+        archive.seek(0)
+        try:
+            tar = tarfile.open(fileobj=archive, mode='r:*')
+        except tarfile.TarError:
+            raise FixletParsingException('unrecognized full site archive format')
+        members = dict((fxf_name(member.name), member) for member in tar
+                       if member.isfile() and member.name.endswith('.fxf'))
+        site = FullSite(members, lambda member: tar.extractfile(member).read())
+
+    if len(members) == 0:
+        raise FixletParsingException('no fixlet files in full site archive')
+    return site
+
 def flatten(lists):
     '''
     Flatten nested lists into one list.
@@ -231,3 +297,13 @@ def parse_fxffile(text):
     fixlets = flatten(filter(lambda x: x is not None, rsplit_fixfile(text)))
     return dict(map(lambda fxf: (fxf.fid, fxf), fixlets))
 
+def parse_fxffile_rows(text):
+    '''
+    Parse a fixfile and return a list of FixletRow tuples, one per fixlet.
+
+    Unlike 'parse_fxffile(text)', the result holds only plain strings, so it is
+    cheap to send back from a worker process.
+    '''
+    fixlets = parse_fxffile(text)
+    return [FixletRow(fid, fixlet.title, fixlet.modified, fixlet.contents)
+            for fid, fixlet in fixlets.iteritems()]
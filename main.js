@@ -1,26 +1,228 @@
 var child_process = require('child_process');
 var express = require('express');
+var path = require('path');
 var sqlite3 = require('sqlite3').verbose();
 
 var DBNAME = 'fxfdata.db';
 var ALL_KEYS = ['relevance', 'text', 'actions'];
 var ALL_REVISION_TYPES = ['added', 'changed', '', 'removed', ''];
+var DIFF_WORKERS = 2; // number of long-lived diff_service.py processes
+var DIFF_TIMEOUT = 10000; // milliseconds before a diff worker is presumed stuck and restarted
+var PAGE_SIZE = 50; // rows per page of the site pages, unless requested otherwise
+var MAX_PAGE_SIZE = 500; // most rows which can be requested in one page
 
 var app = express();
-var db;
+
+// diff_service.py workers, each answering line-delimited JSON requests
+var diffWorkers = [];
+var nextDiffId = 0;
+
+function startDiffWorker() {
+		var worker = {
+				'process': child_process.spawn('python', ['diff_service.py', '--serve']),
+				'pending': {}, // request id -> callback
+				'buffer': '',
+		};
+		worker.process.stdout.setEncoding('utf8');
+		worker.process.stdout.on('data', function(data) {
+				worker.buffer += data;
+				var lines = worker.buffer.split('\n');
+				worker.buffer = lines.pop(); // keep any partial line
+				lines.forEach(function (line) {
+						if (line == '') {
+								return;
+						}
+						var response;
+						try {
+								response = JSON.parse(line);
+						} catch (e) {
+								console.log('warning: dropping malformed line from diff worker: ' + line);
+								return;
+						}
+						var callback = worker.pending[response.id];
+						if (!callback) {
+								// e.g. answered after its worker was presumed stuck
+								console.log('warning: dropping diff worker response to unknown id ' + response.id);
+								return;
+						}
+						delete worker.pending[response.id];
+						callback(response.error || null, response.result);
+				});
+		});
+		worker.process.stderr.on('data', function(data) {
+				console.log('diff worker: ' + data);
+		});
+		worker.process.on('exit', function() {
+				// fail whatever the worker was doing and replace it
+				console.log('warning: diff worker exited, restarting');
+				var pending = worker.pending;
+				worker.pending = {};
+				for (var id in pending) {
+						pending[id]('diff worker exited', null);
+				}
+				diffWorkers[diffWorkers.indexOf(worker)] = startDiffWorker();
+		});
+		return worker;
+}
+
+// diff two rows of RevisionContents; callback(error, [oldContents, newContents])
+function diffRevisions(oldId, newId, callback) {
+		var worker = diffWorkers[0];
+		diffWorkers.forEach(function (candidate) {
+				if (Object.keys(candidate.pending).length < Object.keys(worker.pending).length) {
+						worker = candidate;
+				}
+		});
+
+		var id = nextDiffId++;
+		// diff_service.py bounds its own running time, this is a last resort
+		var timeout = setTimeout(function() {
+				if (id in worker.pending) {
+						console.log('warning: diff ' + oldId + ' ' + newId + ' timed out');
+						worker.process.kill();
+				}
+		}, DIFF_TIMEOUT);
+		worker.pending[id] = function(error, result) {
+				clearTimeout(timeout);
+				callback(error, result);
+		};
+		worker.process.stdin.write(JSON.stringify({'id': id, 'old': oldId, 'new': newId}) + '\n');
+}
+
+// the database is opened once and shared by every request: in a sharded
+// database (see database.py) this is the catalog, and each site's own file is
+// opened once too, with the catalog attached (see siteDatabase)
+var db = new sqlite3.Database(DBNAME);
+var siteDatabases = {}; // site id -> database of a site in a sharded database
+
+// returns the statement for some SQL prepared on a database, prepared on first
+// use and reused by every later request
+function prepared(database, sql) {
+		if (!database.statements) {
+				database.statements = {};
+		}
+		if (!(sql in database.statements)) {
+				database.statements[sql] = database.prepare(sql);
+		}
+		return database.statements[sql];
+}
+
+// gets the first row of a prepared statement; the statement is reset after,
+// since a statement stopped before its end keeps the database locked (and
+// update.py waiting)
+function preparedGet(database, sql, params, callback) {
+		prepared(database, sql).get(params, callback).reset();
+}
+
+// calls back with the database holding a site's data
+function siteDatabase(site, callback) {
+		if (site in siteDatabases) {
+				callback(siteDatabases[site]);
+				return;
+		}
+		db.get('Select filename From Shards Where site=?', site, function(err, row) {
+				if (err || !row) {
+						// not sharded, everything is in one file
+						callback(db);
+						return;
+				}
+				// opened without OPEN_CREATE, so a missing shard is an error rather
+				// than a new empty file
+				var shard = new sqlite3.Database(path.join(path.dirname(DBNAME), row.filename), sqlite3.OPEN_READWRITE, function(err) {
+						if (err) {
+								console.log('warning: could not open the shard of site ' + site + ': ' + err.message);
+						}
+				});
+				shard.run('Attach Database ? As catalog', DBNAME, function(err) {
+						if (err) {
+								// leave it uncached, the next request tries again; queries
+								// on it fail and are answered with a 404
+								shard.close(function() {});
+								callback(db);
+								return;
+						}
+						if (site in siteDatabases) {
+								// opened by another request in the meantime
+								shard.close();
+						} else {
+								siteDatabases[site] = shard;
+						}
+						callback(siteDatabases[site]);
+				});
+		});
+}
+
+// the number of rows in a page of the site pages, from the 'limit' parameter
+function pageSize(req) {
+		var limit = parseInt(req.query['limit']);
+		if (isNaN(limit) || limit < 1) {
+				return PAGE_SIZE;
+		}
+		return Math.min(limit, MAX_PAGE_SIZE);
+}
+
+// a page of the versions of a site after version 'after', each with the number
+// of fixlets affected per revision type; callback(err, versions, next), where
+// next is the version to continue after, or null on the last page
+// (the versions of the page are found first so that whole versions are counted)
+function siteVersionsPage(database, site, after, limit, callback) {
+		var statement = 'Select version, published, type, count(*) as affected From Revisions Where site=$site And version>$after And version<=(Select max(version) From (Select Distinct version From Revisions Where site=$site And version>$after Order By version Limit $limit)) Group By version, type Order By version, type';
+		prepared(database, statement).all({$site: site, $after: after, $limit: limit}, function(err, rows) {
+				if (err) {
+						callback(err);
+						return;
+				}
+				var versions = [];
+				rows.forEach(function(row) {
+						var last = versions[versions.length - 1];
+						if (!last || last.version != row.version) {
+								last = {'version': row.version, 'published': row.published, 'affected': {}};
+								versions.push(last);
+						}
+						last.affected[ALL_REVISION_TYPES[row.type]] = row.affected;
+				});
+				var next = null;
+				if (versions.length == limit) {
+						next = versions[limit - 1].version;
+				}
+				callback(null, versions, next);
+		});
+}
+
+// a page of the fixlets changed in a version of a site, in order of
+// (type, fixlet_id) after the fixlet 'afterFixlet' of type 'afterType';
+// callback(err, changes, next), where next is the {type, fixletId} to continue
+// after, or null on the last page
+function siteChangesPage(database, site, version, afterType, afterFixlet, limit, callback) {
+		var statement = 'Select fixlet_id, type From Revisions Where site=$site And version=$version And (type, fixlet_id)>($type, $fixlet) Order By type, fixlet_id Limit $limit';
+		prepared(database, statement).all({$site: site, $version: version, $type: afterType, $fixlet: afterFixlet, $limit: limit}, function(err, rows) {
+				if (err) {
+						callback(err);
+						return;
+				}
+				var changes = rows.map(function(row) {
+						return {'fixletId': row.fixlet_id, 'type': ALL_REVISION_TYPES[row.type]};
+				});
+				var next = null;
+				if (rows.length == limit) {
+						next = {'type': rows[limit - 1].type, 'fixletId': rows[limit - 1].fixlet_id};
+				}
+				callback(null, changes, next);
+		});
+}
+
+for (var i = 0; i < DIFF_WORKERS; i++) {
+		diffWorkers.push(startDiffWorker());
+}
 
 app.set('views', __dirname + '/frontend');
 
 app.get('/', function(req, res) {
-		sites = [];
+		var sites = [];
 
-		db = new sqlite3.Database(DBNAME);
-		db.serialize(function() {
-				db.each('Select rowid, name From Sites', function(err, row) {
-						sites.push({'id': row.rowid, 'name': row.name});
-				}, function(err, nrows) { res.render('index.ejs', {'sites': sites}); });
-		});
-		db.close();
+		prepared(db, 'Select rowid, name From Sites').each(function(err, row) {
+				sites.push({'id': row.rowid, 'name': row.name});
+		}, function(err, nrows) { res.render('index.ejs', {'sites': sites}); });
 });
 
 // parameters: oldVersion or newVersion = -1 indicates not to diff but just display
@@ -44,6 +246,7 @@ app.get('/diff', function(req, res) {
 
 		var oldContents = {'relevance': [], 'text': [], 'actions': []};
 		var newContents = {'relevance': [], 'text': [], 'actions': []};
+		var degraded = false; // whether the diff was simplified to stay within its budget
 		var siteName, siteUrl, title, revisions;
 
 		var oldId = -1;
@@ -52,70 +255,6 @@ app.get('/diff', function(req, res) {
 		revisions = [];
 		title = -1;
 
-		db = new sqlite3.Database(DBNAME);
-		db.parallelize(function() {
-				var statement;
-				var nextFlag = false; // when oldVersion is -2, used to mark that we should compare with next oldest
-
-				// site info
-				statement = 'Select name, url From Sites Where rowid=?';
-				statement = db.prepare(statement, site);
-				statement.get(function(err, row) {
-						siteName = row.name;
-						siteUrl = row.url;
-				});
-				
-				// table of versions
-				statement = 'Select rowid, version, published, title From Revisions Where site=? and fixlet_id=? Order By version desc';
-				statement = db.prepare(statement, site, fid);
-				statement.each(function(err, row) {
-						if (title == -1) {
-								title = row.title;
-						} else if (row.title != title) {
-								console.log('warning: titles are different across versions');
-								console.log(row.title);
-								console.log(title);
-								title = row.title; // default with newest title ??? TODO order?
-						}
-						revisions.push({'published': row.published, 'version': row.version});
-						if (row.version == oldVersion || nextFlag) {
-								nextFlag = false;
-								oldVersion = row.version;
-								oldId = row.rowid;
-						}
-						if (row.version == newVersion) {
-								newId = row.rowid;
-								if (oldVersion == -2) {
-										nextFlag = true;
-								}
-						}
-				}, function(err, nrows) { // this is in callback to serialize switch on values of old and new IDs
-						if (nextFlag) { // 
-								oldId = -1;
-						}
-						// version contents
-						if (oldId != -1 && newId != -1) {
-								// skip fetching directly (let the diff script do the db work)
-						} else {
-								if (oldId != -1) {
-										statement = 'Select contents From RevisionContents Where id=?';
-										statement = db.prepare(statement, oldId);
-										statement.get(function (err, row) {
-												oldContents = JSON.parse(row.contents);
-												oldContents['text'] = [oldContents['text']]; // TODO should we move this? just makes it easier to render
-										});
-								} else if (newId != -1) {
-										statement = 'Select contents From RevisionContents Where id=?';
-										statement = db.prepare(statement, newId);
-										statement.get(function (err, row) {
-												newContents = JSON.parse(row.contents);
-												newContents['text'] = [newContents['text']]; // TODO should we move this?
-										});
-								}
-						}
-				});
-		});
-
 		function render() {
 				res.render('diff.ejs', {
 						'siteId': site,
@@ -129,39 +268,118 @@ app.get('/diff', function(req, res) {
 						'newVersion': newVersion,
 						'oldContents': oldContents,
 						'newContents': newContents,
+						'degraded': degraded,
+				});
+		}
+
+		// run the diff
+		function diff() {
+				console.log('diff ' + oldId + ' ' + newId);
+				diffRevisions(oldId, newId, function(error, diffContents) {
+						if (error) {
+								console.log('warning: could not diff ' + oldId + ' ' + newId + ': ' + error);
+								render();
+								return;
+						}
+						oldContents = diffContents[0];
+						newContents = diffContents[1];
+						degraded = diffContents[2]['degraded'];
+						oldContents['text'] = [oldContents['text']]; // TODO should we move this? just makes it easier to render
+						newContents['text'] = [newContents['text']]; // TODO should we move this?
+
+						ALL_KEYS.forEach(function (key) {
+								if (oldContents[key] == null) {
+										oldContents[key] = [];
+								}
+								if (newContents[key] == null) {
+										newContents[key] = [];
+								}
+						});
+
+						render();
 				});
 		}
 
-		db.close(function () {
-				// run the diff
-				if (oldId != -1 && newId != -1) {
-						var command = 'python diff_service.py ' + oldId + ' ' + newId;
-						console.log(command);
-						child_process.exec(command, function(error, stdout, stderr) {
-								var diffContents = JSON.parse(stdout);
-								oldContents = diffContents[0];
-								newContents = diffContents[1];
-								oldContents['text'] = [oldContents['text']]; // TODO should we move this? just makes it easier to render
-								newContents['text'] = [newContents['text']]; // TODO should we move this?
-
-								ALL_KEYS.forEach(function (key) {
-										if (oldContents[key] == null) {
-												oldContents[key] = [];
+		siteDatabase(site, function(db) {
+				var nextFlag = false; // when oldVersion is -2, used to mark that we should compare with next oldest
+
+				// site info
+				preparedGet(db, 'Select name, url From Sites Where rowid=?', [site], function(err, row) {
+						if (err || !row) {
+								res.status(404).send('no site ' + site);
+								return;
+						}
+						siteName = row.name;
+						siteUrl = row.url;
+
+						// table of versions
+						var statement = 'Select rowid, version, published, title From Revisions Where site=? and fixlet_id=? Order By version desc';
+						prepared(db, statement).all(site, fid, function(err, rows) {
+								if (err || !rows) {
+										// e.g. the shard of a sharded site is missing
+										console.log('warning: could not read revisions of site ' + site + ': ' + (err && err.message));
+										res.status(404).send('no revisions of site ' + site);
+										return;
+								}
+								rows.forEach(function(row) {
+										if (title == -1) {
+												title = row.title;
+										} else if (row.title != title) {
+												console.log('warning: titles are different across versions');
+												console.log(row.title);
+												console.log(title);
+												title = row.title; // default with newest title ??? TODO order?
 										}
-										if (newContents[key] == null) {
-												newContents[key] = [];
+										revisions.push({'published': row.published, 'version': row.version});
+										if (row.version == oldVersion || nextFlag) {
+												nextFlag = false;
+												oldVersion = row.version;
+												oldId = row.rowid;
+										}
+										if (row.version == newVersion) {
+												newId = row.rowid;
+												if (oldVersion == -2) {
+														nextFlag = true;
+												}
 										}
 								});
+								if (nextFlag) {
+										oldId = -1;
+								}
 
-								render();
+								// version contents
+								if (oldId != -1 && newId != -1) {
+										// skip fetching directly (let the diff script do the db work)
+										diff();
+										return;
+								}
+								if (oldId == -1 && newId == -1) {
+										render();
+										return;
+								}
+								statement = 'Select contents From RevisionContents Where id=?';
+								preparedGet(db, statement, [oldId != -1 ? oldId : newId], function (err, row) {
+										if (err || !row) {
+												res.status(404).send('no contents of fixlet ' + fid);
+												return;
+										}
+										var contents = JSON.parse(row.contents);
+										contents['text'] = [contents['text']]; // TODO should we move this? just makes it easier to render
+										if (oldId != -1) {
+												oldContents = contents;
+										} else {
+												newContents = contents;
+										}
+										render();
+								});
 						});
-				} else {
-						render();
-				}
+				});
 		});
 
 });
 
+// the rows of the site pages are loaded a page at a time from /site/versions
+// and /site/changes, so the page itself only needs the site
 app.get('/site', function(req, res) {
 		var site = req.query['site'];
 		var version = -1;
@@ -169,99 +387,78 @@ app.get('/site', function(req, res) {
 				version = req.query['version'];
 		}
 
-		var revisions = {};
-		var versionData = [];
-		var versions = [];
+		siteDatabase(site, function(db) {
+				preparedGet(db, 'Select name, url From Sites Where rowid=?', [site], function(err, row) {
+						if (err || !row) {
+								res.status(404).send('no site ' + site);
+								return;
+						}
 
-		var published = -1;
-		var changes = {};
+						function render(published) {
+								res.render('site.ejs', {
+										'site': site,
+										'title': row.name,
+										'siteUrl': row.url,
 
-		var title, siteUrl;
-		
-		db = new sqlite3.Database(DBNAME);
-		db.parallelize(function() {
-				var statement;
+										'version': version,
+										'published': published,
+										'pageSize': PAGE_SIZE,
+								});
+						}
 
-				// site info
-				statement = 'Select name, url From Sites Where rowid=?';
-				statement = db.prepare(statement, site);
-				statement.get(function(err, row) {
-						title = row.name;
-						siteUrl = row.url;
+						if (version == -1) {
+								render(-1);
+								return;
+						}
+						var statement = 'Select published From Revisions Where site=? And version=? Limit 1';
+						preparedGet(db, statement, [site, version], function(err, revision) {
+								render(revision ? revision.published : -1);
+						});
 				});
+		});
+});
 
-				if (version == -1) {
-						// site versions
-						statement = 'Select version, published, type, count(*) as affected, count(distinct published) as inconsistencies From Revisions Where site=? Group By version, type Order By version, type';
-						statement = db.prepare(statement, site);
-
-						var i = 0;
-						statement.each(function(err, row) {
-								i += 1;
-								if (!(row.version in revisions)) {
-										revisions[row.version] = {}
-										console.log(i + ": " + row.inconsistencies);
-										versionData.push({
-												'published': row.published,
-												'version': row.version,
-										});
-								}
-								revisions[row.version][ALL_REVISION_TYPES[row.type]] = row.affected;
-						});
-				} else {
-						// version info
-						statement = 'Select fixlet_id, type, published From Revisions Where site=? And version=? Order By type, fixlet_id';
-						statement = db.prepare(statement, site, version);
-						statement.each(function(err, row) {
-								if (!(ALL_REVISION_TYPES[row.type] in changes)) {
-										changes[ALL_REVISION_TYPES[row.type]] = [];
-								}
-								changes[ALL_REVISION_TYPES[row.type]].push(row.fixlet_id);
+// parameters: site, after (the last version of the previous page, or none for
+// the first page) and limit (the number of versions)
+app.get('/site/versions', function(req, res) {
+		var site = req.query['site'];
+		var after = parseInt(req.query['after']);
+		if (isNaN(after)) {
+				after = -1;
+		}
 
-								if (published != -1 && row.published != published) {
-										console.log('warning: publication dates are inconsistent!');
-										console.log(published);
-										console.log(row.published);
-								}
-								published = row.published;
-						});
-				}
+		siteDatabase(site, function(db) {
+				siteVersionsPage(db, site, after, pageSize(req), function(err, versions, next) {
+						if (err) {
+								res.status(500).json({'error': err.message});
+								return;
+						}
+						res.json({'versions': versions, 'next': next});
+				});
 		});
+});
 
-		db.close(function () {
-				if (version == -1) {
-						versionData.forEach(function (version) {
-								var affected_str = '';
-								var total = 0;
-								for (var type in revisions[version.version]) {
-										var number = revisions[version.version][type];
-										total += number;
-										affected_str += ', ' + number + ' ' + type;
-								}
-								affected_str = total + ' (' + affected_str.substring(2) + ')';
-								
-								versions.push({
-										'published': version.published,
-										'version': version.version,
-										'affected': affected_str
-								});
-						});
-				}
-				
-				res.render('site.ejs', {
-						'site': site,
-						'title': title,
-						'siteUrl': siteUrl,
-
-						'version': version,
-						'published': published,
-						'changes': changes,
-						'allRevisionTypes': ALL_REVISION_TYPES,
+// parameters: site, version, after-type and after-fixlet-id (the last change
+// of the previous page, or none for the first page) and limit (the number of
+// changes)
+app.get('/site/changes', function(req, res) {
+		var site = req.query['site'];
+		var version = req.query['version'];
+		var afterType = parseInt(req.query['after-type']);
+		var afterFixlet = parseInt(req.query['after-fixlet-id']);
+		if (isNaN(afterType) || isNaN(afterFixlet)) {
+				afterType = afterFixlet = -1;
+		}
 
-						'revisions': versions
+		siteDatabase(site, function(db) {
+				siteChangesPage(db, site, version, afterType, afterFixlet, pageSize(req), function(err, changes, next) {
+						if (err) {
+								res.status(500).json({'error': err.message});
+								return;
+						}
+						res.json({'changes': changes, 'next': next});
 				});
 		});
-				
 });
 
 app.get('/assets/:thing', function(req, res) {
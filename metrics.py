@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+'''
+A small metrics facility: counters, gauges and histograms with labels, summarized
+periodically to a file of JSON lines and exported in the Prometheus text
+format.
+
+Metrics are declared once at module level:
+
+FETCHES = metrics.counter('fetches_total', 'URLs fetched', ('status',))
+FETCHES.inc(status='200')
+
+and recording them only takes a lock and a dictionary update, so they are
+cheap enough for hot loops.
+'''
+
+import json
+import os
+import threading
+import time
+
+'''
+File which periodic summaries are appended to, one JSON object per line.
+'''
+SUMMARY_FILE = 'metrics.jsonl'
+
+'''
+File which the metrics are written to in the Prometheus text format.
+'''
+PROMETHEUS_FILE = 'metrics.prom'
+
+'''
+Seconds between periodic summaries.
+'''
+SUMMARY_INTERVAL = 60
+
+'''
+Default upper bounds of histogram buckets (in seconds for durations).
+'''
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# all declared metrics, in order of declaration
+registry = []
+
+_lock = threading.Lock()
+
+class Counter:
+    '''
+    A monotonically increasing count per combination of label values.
+    '''
+    kind = 'counter'
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {} # label values -> count
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    def get(self, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with _lock:
+            return self.values.get(key, 0)
+    def _snapshot(self):
+        return dict(self.values)
+
+class Gauge:
+    '''
+    A value which can go up and down per combination of label values.
+    '''
+    kind = 'gauge'
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {} # label values -> value
+    def set(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with _lock:
+            self.values[key] = value
+    def _snapshot(self):
+        return dict(self.values)
+
+class Histogram:
+    '''
+    Counts of observed values in buckets, with their sum and count, per
+    combination of label values.
+    '''
+    kind = 'histogram'
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {} # label values -> [bucket counts..., sum, count]
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with _lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+    def time(self, **labels):
+        '''
+        Returns a context manager which observes how long its body takes.
+        '''
+        return _Timer(self, labels)
+    def _snapshot(self):
+        return dict((key, list(data)) for key, data in self.values.iteritems())
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+    def __enter__(self):
+        self.start = time.time()
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+def counter(name, description, labels=()):
+    '''Declare a Counter.'''
+    metric = Counter(name, description, labels)
+    registry.append(metric)
+    return metric
+
+def gauge(name, description, labels=()):
+    '''Declare a Gauge.'''
+    metric = Gauge(name, description, labels)
+    registry.append(metric)
+    return metric
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    '''Declare a Histogram.'''
+    metric = Histogram(name, description, labels, buckets)
+    registry.append(metric)
+    return metric
+
+def snapshot():
+    '''
+    Returns a consistent copy of every metric as a list of
+    (metric, {label values: value}) pairs.
+    '''
+    with _lock:
+        return [(metric, metric._snapshot()) for metric in registry]
+
+def summary():
+    '''
+    Returns a JSON-serializable summary of every metric: values for counters
+    and gauges, and count, sum and mean for histograms.
+    '''
+    metrics = {}
+    for metric, values in snapshot():
+        entries = []
+        for key, value in sorted(values.iteritems()):
+            entry = {'labels': dict(zip(metric.labels, key))}
+            if metric.kind != 'histogram':
+                entry['value'] = value
+            else:
+                entry['count'] = value[-1]
+                entry['sum'] = value[-2]
+                entry['mean'] = value[-2] / value[-1] if value[-1] else None
+            entries.append(entry)
+        metrics[metric.name] = entries
+    return {'time': time.time(), 'metrics': metrics}
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+def prometheus_text():
+    '''
+    Returns every metric in the Prometheus text exposition format.
+    '''
+    lines = []
+    for metric, values in snapshot():
+        lines.append('# HELP {} {}'.format(metric.name, metric.description))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for key, value in sorted(values.iteritems()):
+            if metric.kind != 'histogram':
+                lines.append('{}{} {}'.format(metric.name, _labels(metric.labels, key), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    metric.name, _labels(metric.labels, key, [('le', repr(float(bound)))]), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                metric.name, _labels(metric.labels, key, [('le', '+Inf')]), value[-1]))
+            lines.append('{}_sum{} {}'.format(metric.name, _labels(metric.labels, key), value[-2]))
+            lines.append('{}_count{} {}'.format(metric.name, _labels(metric.labels, key), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+def write():
+    '''
+    Append a summary to SUMMARY_FILE and rewrite PROMETHEUS_FILE.
+    '''
+    with open(SUMMARY_FILE, 'a') as f:
+        f.write(json.dumps(summary()) + '\n')
+    # write then rename, so that readers never see a partial file
+    with open(PROMETHEUS_FILE + '.tmp', 'w') as f:
+        f.write(prometheus_text())
+    os.rename(PROMETHEUS_FILE + '.tmp', PROMETHEUS_FILE)
+
+class _Reporter(threading.Thread):
+    def __init__(self, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stopped = threading.Event()
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            write()
+
+_reporter = None
+
+def start(interval=SUMMARY_INTERVAL):
+    '''
+    Start writing the metrics every 'interval' seconds in the background.
+    '''
+    global _reporter
+    if _reporter is None:
+        _reporter = _Reporter(interval)
+        _reporter.start()
+
+def stop():
+    '''
+    Stop writing the metrics in the background and write them one last time.
+    '''
+    global _reporter
+    if _reporter is not None:
+        _reporter.stopped.set()
+        _reporter.join()
+        _reporter = None
+    write()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+'''
+Writes a report of every fixlet changed in one version of a site: for each
+revision published in that version, its differential against the previous
+revision of the same fixlet (see diff_service.py). New fixlets are diffed
+against empty contents.
+
+The differentials are computed in a pool of worker processes, each with its
+own database connection (to the site's own file in a sharded database).
+
+e.g.
+python site_report.py bessecurity 2045 --format html --output report.html
+'''
+
+import argparse
+import cgi
+import json
+import multiprocessing
+import os.path
+import sys
+
+import database
+import diff_service
+
+'''
+Contents used as the previous revision of a new fixlet.
+'''
+EMPTY_CONTENTS = {'relevance': [], 'text': [], 'actions': []}
+
+'''
+Stylesheet of the server's diff pages, inlined into HTML reports so that they
+are styled wherever they are opened.
+'''
+STYLESHEET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frontend', 'assets', 'fxfmine.css')
+
+# database connection and DiffCache of each worker process, see init_worker();
+# the cache is kept for every change so its size is only counted once
+connection = None
+cache = None
+
+def init_worker(dbname, site_id):
+    global connection, cache
+    connection = database.connect(dbname, site_id, create=False)
+    cache = diff_service.DiffCache(connection)
+
+def diff_change(change):
+    '''
+    Given a change as returned by site_version_changes, returns it together
+    with its differential. Runs in a worker process.
+    '''
+    old_id, new_id = change['old_id'], change['new_id']
+    if old_id is None:
+        change['result'] = diff_service.diff_contents(
+            EMPTY_CONTENTS, diff_service.load_contents(connection, new_id))
+    else:
+        change['result'] = diff_service.diff_revisions(connection, old_id, new_id, cache)
+    return change
+
+def site_version_changes(connection, site_id, version):
+    '''
+    Returns a list of the revisions of a site published in some version, as
+    dictionaries with the ids and versions of each revision and the revision
+    before it.
+    '''
+    rows = connection.execute('''
+Select N.fixlet_id, N.title, N.type, N.rowid, P.rowid, P.version
+From Revisions N Left Join Revisions P
+  On P.site=N.site And P.fixlet_id=N.fixlet_id
+  And P.version=(Select max(version) From Revisions
+                 Where site=N.site And fixlet_id=N.fixlet_id And version<N.version)
+Where N.site=? And N.version=?
+Order By N.type, N.fixlet_id''', (site_id, version)).fetchall()
+
+    changes = [{'fixlet_id': fixlet_id, 'title': title,
+                'type': database.revtype_name(revision_type),
+                'new_id': new_id, 'new_version': version,
+                'old_id': old_id, 'old_version': old_version}
+               for fixlet_id, title, revision_type, new_id, old_id, old_version in rows]
+    return changes
+
+def render_html(report):
+    '''
+    Renders a report as a standalone HTML page, styled like the diff pages of
+    the server.
+    '''
+    with open(STYLESHEET) as f:
+        stylesheet = f.read().decode('utf-8')
+    # unicode templates, since titles and diffs may not be ASCII
+    html = [u'<html><head><title>Version {} of {}</title>'.format(report['version'],
+                                                                 cgi.escape(report['site'])),
+            u'<style type="text/css">', stylesheet, u'</style>',
+            u'</head><body>',
+            u'<div class="small-page-header">Version {} of {} - {} fixlets changed</div>'.format(
+                report['version'], cgi.escape(report['site']), len(report['fixlets']))]
+    for change in report['fixlets']:
+        since = u'' if change['old_id'] is None else u' (since version {})'.format(change['old_version'])
+        html.append(u'<div class="small-page-header"><span class="muted">(ID:{})</span> {} '
+                    u'<span class="muted">- {}{}</span></div>'.format(
+                        change['fixlet_id'], cgi.escape(change['title'] or u''),
+                        change['type'], since))
+        html.append(u'<div class="diff-container">')
+        old_file, new_file, info = change['result']
+        if info['degraded']:
+            html.append(u'<div class="diff-label"><span class="muted">simplified</span></div>')
+        for key in diff_service.ALL_KEYS:
+            for i, (old, new) in enumerate(zip(old_file.get(key, []), new_file.get(key, []))):
+                html += [u'<div class="diff-label">{} #{}</div>'.format(key, i+1),
+                         u'<div class="diff-panel-container">',
+                         u'<div class="diff-panel">{}</div>'.format(old or u'<span class="muted">added</span>'),
+                         u'<div class="diff-panel">{}</div>'.format(new or u'<span class="muted">removed</span>'),
+                         u'</div>']
+        html.append(u'</div>')
+    html.append(u'</body></html>')
+    return u'\n'.join(html)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Report every fixlet changed in a site version.')
+    parser.add_argument('site', help='name or id of the site')
+    parser.add_argument('version', type=int, help='version of the site')
+    parser.add_argument('--format', choices=('json', 'html'), default='json')
+    parser.add_argument('--output', help='file to write the report to (default: stdout)')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('--database', default=diff_service.DBNAME)
+    options = parser.parse_args(argv)
+
+    site_id, site_name = database.find_site(options.database, options.site)
+    main_connection = database.connect(options.database, site_id, create=False)
+    try:
+        changes = site_version_changes(main_connection, site_id, options.version)
+    finally:
+        main_connection.close()
+
+    pool = multiprocessing.Pool(options.processes, init_worker, (options.database, site_id))
+    try:
+        fixlets = pool.map(diff_change, changes, chunksize=4)
+    finally:
+        pool.close()
+        pool.join()
+
+    report = {'site': site_name, 'site_id': site_id,
+              'version': options.version, 'fixlets': fixlets}
+    if options.format == 'html':
+        output = render_html(report).encode('utf-8')
+    else:
+        output = json.dumps(report)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+'''
+Generators for synthetic BigFix content: gather site listings, site metadata
+and fixlet (.fxf) files. The output follows the formats that fixlet_parser
+reads from sync.bigfix.com, so it can stand in for sync wherever real content
+is unavailable (e.g. offline benchmarks).
+
+All generators are deterministic for a given seed.
+'''
+
+import hashlib
+import random
+
+'''
+The root of the synthetic sync server's urls.
+'''
+SYNC_URL = 'http://sync.bigfix.com'
+
+'''
+The boundary separating the parts of a gather listing.
+'''
+GATHER_BOUNDARY = 'bigfix_gather_boundary'
+
+'''
+Words used to build fixlet titles, descriptions and relevance.
+'''
+WORDS = ('security', 'update', 'windows', 'office', 'patch', 'bulletin',
+         'registry', 'service', 'version', 'file', 'client', 'server',
+         'install', 'remove', 'hotfix', 'package', 'critical', 'kernel')
+
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for i in range(count))
+
+def _timestamp(rng):
+    return '{}, {:02d} {} {} {:02d}:{:02d}:{:02d} +0000'.format(
+        rng.choice(DAYS), rng.randint(1, 28), rng.choice(MONTHS),
+        rng.randint(2004, 2014), rng.randint(0, 23), rng.randint(0, 59),
+        rng.randint(0, 59))
+
+def _boundary(counter):
+    '''
+    Returns a fresh multipart boundary. Boundaries have a fixed width and a
+    terminator so that no boundary is a prefix of another.
+    '''
+    counter[0] += 1
+    return '=_bigfix_{:08d}_='.format(counter[0])
+
+def fxffile_url(site, version, name, sync_url=SYNC_URL):
+    '''
+    Returns the url of the fixlet file named 'name' (without .fxf)
+    at some version of a site.
+    '''
+    return '{}/bfsites/{}_{}/{}.fxf'.format(sync_url, site, version, name)
+
+def gather_url(site, sync_url=SYNC_URL):
+    '''
+    Returns the url of a site's gather listing.
+    '''
+    return '{}/cgi-bin/bfgather/{}'.format(sync_url, site)
+
+def site_metadata(site, version, relevance=1, sync_url=SYNC_URL):
+    '''
+    Returns the metadata of a site at some version as a list of
+    property-value pairs, as returned by fixlet_parser.parse_directory_metadata.
+    '''
+    properties = [
+        ('MIME-Version', '1.0'),
+        ('FullSiteURL', '{}/bfsites/{}_{}/__fullsite'.format(sync_url, site, version)),
+        ('Version', str(version)),
+        ('Site-Name', site),
+    ]
+    for i in range(relevance):
+        properties.append(('Relevance', 'exists file "site{}.dat"'.format(i)))
+    return properties
+
+def gather_listing(site, version, entries, hashinfo=True, metadata=None, sync_url=SYNC_URL):
+    '''
+    Returns the text of a gather listing for some version of a site.
+
+    'entries' is a list of (name, text) pairs where 'name' is the name of a
+    fixlet file without .fxf and 'text' is its contents. If 'hashinfo' is
+    False, the HASHINFO attribute is left out of each entry as it is on some
+    sites. 'metadata' defaults to site_metadata(site, version). Urls point
+    to 'sync_url' in place of sync.bigfix.com.
+    '''
+    if metadata is None:
+        metadata = site_metadata(site, version, sync_url=sync_url)
+
+    lines = ['MIME-Version: 1.0',
+             'Content-Type: multipart/mixed; boundary="{}"'.format(GATHER_BOUNDARY),
+             '',
+             '--' + GATHER_BOUNDARY]
+    lines += ['{}: {}'.format(key, value) for key, value in metadata
+              if key != 'MIME-Version']
+    lines.append('')
+
+    # each entry is a part with no headers of its own
+    for name, text in entries:
+        data = text.encode('windows-1252') if isinstance(text, unicode) else text
+        lines += ['--' + GATHER_BOUNDARY,
+                  '',
+                  'URL: ' + fxffile_url(site, version, name, sync_url),
+                  'NAME: {}.fxf'.format(name),
+                  'MODIFIED: Wed, 29 Jan 2014 07:00:37 +0000',
+                  'SIZE: {}'.format(len(data)),
+                  'TYPE: FILE',
+                  'HASH: ' + hashlib.sha1(data).hexdigest()]
+        if hashinfo:
+            lines.append('HASHINFO: sha256,' + hashlib.sha256(data).hexdigest())
+        lines.append('')
+
+    lines += ['--{}--'.format(GATHER_BOUNDARY), '', '']
+    return '\n'.join(lines)
+
+def _fixlet(rng, counter, fid, action_size):
+    boundary = _boundary(counter)
+    actions = []
+    while sum(map(len, actions)) < action_size:
+        actions.append('regset "[HKEY_LOCAL_MACHINE\\SOFTWARE\\{}]" "{}"=dword:{:08x}'.format(
+            _words(rng, 2).title().replace(' ', ''), rng.choice(WORDS), rng.randint(0, 2**31)))
+        actions.append('waithidden "{{pathname of system folder}}\\{}.exe" /quiet'.format(rng.choice(WORDS)))
+
+    lines = ['Subject: ' + _words(rng, 6).title(),
+             'X-Fixlet-ID: {}'.format(fid),
+             'X-Fixlet-Modification-Time: ' + _timestamp(rng),
+             'X-Relevant-When: exists file "{}.dll" whose (version of it < "{}.{}")'.format(
+                 rng.choice(WORDS), rng.randint(1, 9), rng.randint(0, 99)),
+             'X-Relevant-When: not exists key "{}" of registry'.format(_words(rng, 3)),
+             'Content-Type: multipart/related; boundary="{}"'.format(boundary),
+             '',
+             '--' + boundary,
+             'Content-Type: text/html; charset=us-ascii',
+             '',
+             '<!-- generated description -->',
+             '<P>{}</P>'.format(_words(rng, 40)),
+             '<P>{} &amp; {}</P>'.format(_words(rng, 12), _words(rng, 12)),
+             '',
+             '--' + boundary,
+             'Content-Type: application/x-Fixlet-Windows-Shell',
+             '']
+    lines += actions
+    lines += ['', '--{}--'.format(boundary), '']
+    return '\n'.join(lines)
+
+def _digest(rng, counter, fids, relevance_depth, action_size):
+    boundary = _boundary(counter)
+    lines = ['X-Relevant-When: exists folder "{}" whose (exists file "{}.ini" of it)'.format(
+                 _words(rng, 2), rng.choice(WORDS)),
+             'Content-Type: multipart/digest; boundary="{}"'.format(boundary),
+             '']
+    if relevance_depth > 1:
+        # split the remaining fixlets between two nested digests
+        half = (len(fids) + 1) // 2
+        parts = [_digest(rng, counter, part, relevance_depth-1, action_size)
+                 for part in (fids[:half], fids[half:]) if part]
+    else:
+        parts = [_fixlet(rng, counter, fid, action_size) for fid in fids]
+    for part in parts:
+        lines += ['--' + boundary, part]
+    lines += ['--{}--'.format(boundary), '']
+    return '\n'.join(lines)
+
+def fxffile(fixlets=10, relevance_depth=1, action_size=200, first_id=1, seed=0):
+    '''
+    Returns the text of a fixlet file containing 'fixlets' fixlets with
+    consecutive ids starting at 'first_id'.
+
+    The fixlets are nested 'relevance_depth' levels deep in multipart/digest
+    sections, each level adding its own relevance. 'action_size' is the
+    approximate size in characters of each fixlet's action script.
+    '''
+    rng = random.Random(seed)
+    counter = [0]
+    fids = range(first_id, first_id + fixlets)
+    header = ['MIME-Version: 1.0',
+              'X-Fixlet-Site: synthetic']
+    return '\n'.join(header) + '\n' + _digest(rng, counter, fids,
+                                             max(relevance_depth, 1), action_size)
+
+def site_files(files=5, fixlets=10, relevance_depth=1, action_size=200, seed=0):
+    '''
+    Returns a list of (name, text) pairs of fixlet files for a synthetic site,
+    suitable for gather_listing. Fixlet ids are unique across the files.
+    '''
+    return [('{:04d}'.format(i),
+             fxffile(fixlets, relevance_depth, action_size,
+                     first_id=i*fixlets + 1, seed=seed*files + i))
+            for i in range(files)]
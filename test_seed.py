@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+'''
+Tests of seeding and updating (see dataminer.py) against a local stand-in for
+sync.bigfix.com (see fake_sync.py), and of reading the result.
+
+python -m unittest test_seed
+'''
+
+import glob
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import database
+import dataminer
+import export
+import fake_sync
+import synthetic_corpus
+
+class SeedTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp(prefix='test_seed_')
+        os.chdir(self.workdir)
+        self.fetch_backoff = dataminer.FETCH_BACKOFF
+        dataminer.FETCH_BACKOFF = 0
+        # the missing urls of another test's working directory
+        dataminer.missing_urls = {}
+        dataminer.unsaved_missing = []
+        database._sharded = {}
+        self.sharded = database.SHARDED
+
+    def tearDown(self):
+        dataminer.FETCH_BACKOFF = self.fetch_backoff
+        database.SHARDED = self.sharded
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def seed(self, sites):
+        server = fake_sync.SyncServer(sites)
+        server.start()
+        try:
+            self.seed_from(server)
+        finally:
+            server.shutdown()
+
+    def seed_from(self, server):
+        with open(dataminer.GATHER_SITES, 'w') as f:
+            f.write('\n'.join(server.gather_urls()) + '\n')
+        dataminer.seed()
+
+    def test_broken_file_does_not_lose_site(self):
+        # every version of 0002 fails, so its first version is never found
+        site = fake_sync.SyncSite('synthetic', 3, files=5, broken=['0002'])
+        self.seed([site])
+
+        connection = sqlite3.connect(database.DBNAME)
+        try:
+            sites = connection.execute('SELECT rowid, name FROM Sites').fetchall()
+            self.assertEqual([name for site_id, name in sites], ['synthetic'])
+            names = [name for (name,) in connection.execute(
+                'SELECT name FROM FxfFiles WHERE site=? ORDER BY name', (sites[0][0],))]
+            self.assertEqual(names, ['0000', '0001', '0003', '0004'])
+            fixlets = connection.execute('SELECT count(*) FROM Revisions WHERE site=?',
+                                         (sites[0][0],)).fetchone()[0]
+            self.assertEqual(fixlets, 4 * site.fixlets)
+        finally:
+            connection.close()
+
+    def test_missing_versions_are_not_requested_again(self):
+        # the first version of every file is 3, so seeding probes 1 and 2
+        site = fake_sync.SyncSite('synthetic', 4, files=3, missing=[1, 2])
+        server = fake_sync.SyncServer([site])
+        server.start()
+        try:
+            self.seed_from(server)
+            self.assertEqual(server.requests[('fxf', 404)], 6)
+
+            # seed from scratch in a new process, keeping only MISSING_CACHE
+            dataminer.missing_urls = {}
+            for filename in glob.glob('fxfdata*.db') + [dataminer.FIRST_FILE_CACHE]:
+                os.remove(filename)
+            avoided = dataminer.MISSING_AVOIDED.get()
+            self.seed_from(server)
+            self.assertEqual(server.requests[('fxf', 404)], 6)
+            self.assertEqual(dataminer.MISSING_AVOIDED.get() - avoided, 6)
+        finally:
+            server.shutdown()
+
+    def test_plan_counts_added_file_probes_apart(self):
+        site = fake_sync.SyncSite('synthetic', 6, published=1, files=2, added_files=1)
+        server = fake_sync.SyncServer([site])
+        server.start()
+        try:
+            self.seed_from(server)
+            site.publish(6)
+            plans = dataminer.plan()
+            self.assertEqual(plans[0]['added_files'], 1)
+            self.assertEqual(plans[0]['added_probe_upper_bound'], 5)
+
+            # versions known to be missing are never probed
+            dataminer.record_missing(synthetic_corpus.fxffile_url('synthetic', 3, '0002', server.url))
+            plans = dataminer.plan()
+            self.assertEqual(plans[0]['added_probe_upper_bound'], 4)
+            self.assertEqual(plans[0]['added_requests'], 2)
+        finally:
+            server.shutdown()
+
+    def test_removed_fixlet_leaves_snapshots(self):
+        # the last fixlet of the only file (ids 1 to 3) is removed at version 2
+        site = fake_sync.SyncSite('synthetic', 3, published=1, files=1, fixlets=3,
+                                  change_rate=0, removed=[('0000', 2)])
+        server = fake_sync.SyncServer([site])
+        server.start()
+        try:
+            self.seed_from(server)
+            site.publish(3)
+            dataminer.update()
+        finally:
+            server.shutdown()
+
+        connection = database.connect(create=False)
+        try:
+            def snapshot(version):
+                return sorted(fixlet['fixlet_id'] for fixlet in
+                              export.revisions(connection, 1, version))
+            self.assertEqual(snapshot(1), [1, 2, 3])
+            self.assertEqual(snapshot(2), [1, 2])
+            self.assertEqual(snapshot(None), [1, 2])
+        finally:
+            connection.close()
+
+    def test_export_does_not_create_missing_shard(self):
+        database.SHARDED = True
+        self.seed([fake_sync.SyncSite('synthetic', 2, files=2)])
+        shard = database.shard_name(database.DBNAME, 1)
+        os.remove(shard)
+
+        self.assertRaises(IOError, export.main, ['synthetic', '--output', 'out.jsonl'])
+        self.assertFalse(os.path.exists(shard))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+'''
+An adaptive limit on the number of calls (e.g. requests to a server) in
+progress at the same time.
+
+The limit is adjusted the way TCP adjusts its congestion window, by additive
+increase and multiplicative decrease (AIMD): it grows by one for every limit's
+worth of calls which succeed in time, and is halved whenever a call fails or
+is slow. Only calls started after the last decrease can decrease it again, so
+that a burst of failures from requests which were all in flight together
+counts once.
+
+LIMIT = throttle.AIMDLimit(1, 64, initial=16, slow_seconds=2)
+started = LIMIT.acquire()
+... make the call ...
+LIMIT.release(started, ok, latency)
+'''
+
+import threading
+import time
+
+class AIMDLimit:
+    '''
+    Lets at most 'limit' callers between acquire() and release() at a time,
+    with the limit kept between 'minimum' and 'maximum'.
+
+    A call is slow if its latency (as given to release, e.g. the time until
+    the response headers arrived, so that large downloads do not count)
+    is over 'slow_seconds'. Every 'log_interval' seconds, the limit and the
+    rate of calls and bytes completed since the last time are printed.
+    '''
+    def __init__(self, minimum, maximum, initial=None, slow_seconds=2.0,
+                 decrease_factor=0.5, name='calls', log_interval=60):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(maximum if initial is None else min(max(initial, minimum), maximum))
+        self.slow_seconds = slow_seconds
+        self.decrease_factor = decrease_factor
+        self.name = name
+        self.log_interval = log_interval
+        self.in_flight = 0
+        self.decreased_at = 0
+        self.condition = threading.Condition()
+        # since the last log line
+        self.logged_at = time.time()
+        self.calls = 0
+        self.bytes = 0
+        self.decreases = 0
+
+    def acquire(self):
+        '''
+        Waits until fewer than 'limit' calls are in progress, and returns the
+        time the call started, to be given to release().
+        '''
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return time.time()
+
+    def release(self, started, ok, latency=None, size=0):
+        '''
+        Ends a call started at 'started', which succeeded if 'ok', with some
+        latency (by default the time since it started) and 'size' bytes of
+        result, and adjusts the limit.
+        '''
+        now = time.time()
+        if latency is None:
+            latency = now - started
+        line = None
+        with self.condition:
+            self.in_flight -= 1
+            self.calls += 1
+            self.bytes += size
+            if ok and latency <= self.slow_seconds:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif started >= self.decreased_at:
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self.decreased_at = now
+                self.decreases += 1
+            self.condition.notify_all()
+
+            elapsed = now - self.logged_at
+            if elapsed >= self.log_interval:
+                line = '{}: limit {:.1f} ({} in flight), {:.1f}/s, {:.2f} MB/s, {} decreases'.format(
+                    self.name, self.limit, self.in_flight, self.calls / elapsed,
+                    self.bytes / elapsed / 2**20, self.decreases)
+                self.logged_at = now
+                self.calls = self.bytes = self.decreases = 0
+        if line is not None:
+            print line
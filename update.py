@@ -1,6 +1,34 @@
 #!/usr/bin/env python
 
+import sys
+import database
 import dataminer
 
 if __name__ == '__main__':
-    dataminer.update()
+    # --order=largest or --order=round-robin picks the order sites are updated
+    # in (see dataminer.UPDATE_ORDER)
+    order = dataminer.UPDATE_ORDER
+    for arg in sys.argv[1:]:
+        if arg.startswith('--order='):
+            order = arg[len('--order='):]
+    if not order in dataminer.UPDATE_ORDERS:
+        sys.exit('unknown order {}, expected one of: {}'.format(
+            order, ', '.join(dataminer.UPDATE_ORDERS)))
+
+    # with --dry-run, only print how much work the update would do (with
+    # --files, for every outdated file too) without fetching any fixlet file
+    if '--dry-run' in sys.argv[1:]:
+        dataminer.plan(order, '--files' in sys.argv[1:])
+        sys.exit(0)
+
+    # with --precompute-diffs, every revision added by this update is diffed
+    # against the previous revision of its fixlet and the result is cached
+    precompute_diffs = '--precompute-diffs' in sys.argv[1:]
+    if precompute_diffs:
+        first_new = database.next_rowids()
+
+    dataminer.update(order)
+
+    if precompute_diffs:
+        import diff_service
+        print 'precomputed {} diffs'.format(diff_service.precompute(diff_service.DBNAME, first_new))